@@ -1,20 +1,781 @@
-import csv, json, time, ast, math, sys
+import csv, json, time, ast, math, re, sys, os, io, codecs, mmap, contextlib, functools, bisect, heapq, itertools, multiprocessing
+from array import array
+from collections import OrderedDict, Counter, deque
 from prettytable import PrettyTable
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 TABLES = {}
+WAL = None
+HISTOGRAM_BUCKETS = 20
+BULK_BATCH_ROWS = 100000
+PARALLEL_LOAD_BYTES = 1 << 22
+TABLE_FILE_MAGIC = b"P3TABLE1"
+WAL_GROUP_RECORDS = 1024
+WAL_CHECKPOINT_BYTES = 1 << 26
+SORTED_INDEX_SPLICES = 64
+PLAN_CACHE_SIZE = 256
+PLAN_CACHE = OrderedDict()
+PREPARED = {}
+PARAM_MARKER = "'?param{}?'"
+CURSOR_BATCH_ROWS = 1000
+RESULT_CACHE = OrderedDict()
+RESULT_STATS = {"hits":0, "misses":0, "bytes":0}
+SETTINGS = {
+    "vectorized":np is not None,
+    "load_workers":os.cpu_count() or 1,
+    "result_cache_bytes":1 << 26
+}
 dtypes = {
     "varchar":{
         "cast":str,
         "size":1
     },
     "float":{
-        "cast":float
+        "cast":float,
+        "typecode":"d"
     },
     "int":{
-        "cast":int
+        "cast":int,
+        "typecode":"q"
     }
 }
 
+# region STORAGE ########################################################################
+class Column:
+    """
+    Typed, array-backed storage for a single numeric column.
+    Values are addressed by dense row ids. A column reopened from
+    a saved table is a view of the mapped file until it grows.
+    """
+
+    def __init__(self, typecode, data = None):
+        self.typecode = typecode
+        self.data = array(typecode) if data is None else data
+
+    def grow(self):
+        # Copy a mapped column into an array before its length changes
+        if isinstance(self.data, memoryview):
+            data = array(self.typecode)
+            data.frombytes(self.data.cast("B"))
+            self.data = data
+
+    def __getitem__(self, rid):
+        return self.data[rid]
+
+    def __setitem__(self, rid, val):
+        self.data[rid] = val
+
+    def __len__(self):
+        return len(self.data)
+
+    def append(self, val):
+        self.grow()
+        self.data.append(val)
+
+    def pop(self):
+        self.grow()
+        self.data.pop()
+
+    def extend(self, values):
+        self.grow()
+        self.data.extend(values)
+
+    def take(self, rids):
+        # Iterates the values of a list of row ids
+        return map(self.data.__getitem__, rids)
+
+    def truncate(self, n):
+        self.grow()
+        del self.data[n:]
+
+    def fits(self, val):
+        # Whether a value can be stored in the column's typed array
+        try:
+            array(self.typecode, [val])
+        except (OverflowError, TypeError):
+            return False
+        return True
+
+    def to_numpy(self):
+        """
+        Returns a zero-copy NumPy view of the column. The view must be
+        dropped before the column is appended to again.
+        """
+        return np.frombuffer(self.data, dtype = self.typecode)
+
+    def nbytes(self):
+        if isinstance(self.data, memoryview):
+            return self.data.nbytes
+        return sys.getsizeof(self.data)
+
+class VarcharColumn:
+    """
+    Dictionary-encoded storage for a varchar column. Each distinct
+    string is stored once in self.dictionary and rows hold a small
+    integer code into it. A column reopened from a saved table maps
+    its codes from the file and decodes its dictionary page on first use.
+    """
+
+    def __init__(self, codes = None, page = None):
+        self.codes = array("i") if codes is None else codes
+        self.page = page
+        if page is None:
+            self.dictionary = []
+            self.lookup = {}
+
+    def __getattr__(self, name):
+        if self.__dict__.get("page") is None:
+            raise AttributeError(name)
+        if name == "dictionary":
+            self.dictionary = json.loads(bytes(self.page))
+        elif name == "lookup":
+            self.lookup = {val:code for code, val in enumerate(self.dictionary)}
+            self.page = None
+        else:
+            raise AttributeError(name)
+        return self.__dict__[name]
+
+    def grow(self):
+        # Copy mapped codes into an array before their length changes
+        if isinstance(self.codes, memoryview):
+            codes = array("i")
+            codes.frombytes(self.codes.cast("B"))
+            self.codes = codes
+
+    def encode(self, val):
+        code = self.lookup.get(val)
+        if code is None:
+            code = len(self.dictionary)
+            self.lookup[val] = code
+            self.dictionary.append(val)
+        return code
+
+    def __getitem__(self, rid):
+        return self.dictionary[self.codes[rid]]
+
+    def __setitem__(self, rid, val):
+        self.codes[rid] = self.encode(val)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def append(self, val):
+        self.grow()
+        self.codes.append(self.encode(val))
+
+    def pop(self):
+        self.grow()
+        self.codes.pop()
+
+    def extend(self, values):
+        self.grow()
+        new = list(set(values).difference(self.lookup))
+        self.lookup.update(zip(new, range(len(self.dictionary), len(self.dictionary) + len(new))))
+        self.dictionary.extend(new)
+        self.codes.extend(map(self.lookup.__getitem__, values))
+
+    def truncate(self, n):
+        self.grow()
+        del self.codes[n:]
+
+    def fits(self, val):
+        return isinstance(val, str)
+
+    def take(self, rids):
+        # Iterates the values of a list of row ids
+        return map(self.dictionary.__getitem__, map(self.codes.__getitem__, rids))
+
+    def to_numpy(self):
+        """
+        Returns the decoded column as a NumPy object array
+        """
+        return np.array(self.dictionary, dtype = object)[np.frombuffer(self.codes, dtype = "i")]
+
+    def nbytes(self):
+        codes = self.codes.nbytes if isinstance(self.codes, memoryview) else sys.getsizeof(self.codes)
+        if "dictionary" not in self.__dict__:
+            return codes + self.page.nbytes
+        return codes + sys.getsizeof(self.dictionary) + sys.getsizeof(self.lookup)\
+            + sum(sys.getsizeof(v) for v in self.dictionary)
+
+class KeyColumn:
+    """
+    Plain list storage for a varchar primary key column. Every key is
+    distinct, so a dictionary would hold each string again next to the
+    key index, and the rows hold the same string objects the key index
+    does. A column reopened from a saved table decodes its page on first use.
+    """
+
+    def __init__(self, page = None):
+        self.page = page
+        if page is None:
+            self.data = []
+
+    def __getattr__(self, name):
+        if name != "data" or self.__dict__.get("page") is None:
+            raise AttributeError(name)
+        self.data = json.loads(bytes(self.page))
+        self.page = None
+        return self.data
+
+    def __getitem__(self, rid):
+        return self.data[rid]
+
+    def __setitem__(self, rid, val):
+        self.data[rid] = val
+
+    def __len__(self):
+        return len(self.data)
+
+    def append(self, val):
+        self.data.append(val)
+
+    def pop(self):
+        self.data.pop()
+
+    def extend(self, values):
+        self.data.extend(values)
+
+    def truncate(self, n):
+        del self.data[n:]
+
+    def fits(self, val):
+        return isinstance(val, str)
+
+    def take(self, rids):
+        # Iterates the values of a list of row ids
+        return map(self.data.__getitem__, rids)
+
+    def to_numpy(self):
+        return np.array(self.data, dtype = object)
+
+    def nbytes(self):
+        if "data" not in self.__dict__:
+            return self.page.nbytes
+        return sys.getsizeof(self.data) + sum(sys.getsizeof(v) for v in self.data)
+
+# Bit positions set in each byte value, used to list the row ids in a Bitmap
+BYTE_BITS = [tuple(b for b in range(8) if byte >> b & 1) for byte in range(256)]
+
+class Bitmap:
+    """
+    Set of row ids stored as the bits of a Python int, so that AND, OR
+    and NOT of predicate results are single big-integer operations.
+    """
+
+    __slots__ = ("bits",)
+
+    def __init__(self, bits = 0):
+        self.bits = bits
+
+    @classmethod
+    def from_rids(cls, rids):
+        if not rids:
+            return cls()
+        if np is not None:
+            mask = np.zeros(max(rids) + 1, dtype = bool)
+            mask[rids] = True
+            return cls.from_mask(mask)
+        buf = bytearray((max(rids) >> 3) + 1)
+        for rid in rids:
+            buf[rid >> 3] |= 1 << (rid & 7)
+        return cls(int.from_bytes(buf, "little"))
+
+    @classmethod
+    def from_mask(cls, mask):
+        """
+        Builds a bitmap from a NumPy boolean mask indexed by row id
+        """
+        return cls(int.from_bytes(np.packbits(mask, bitorder = "little").tobytes(), "little"))
+
+    def to_rids(self):
+        """
+        Returns the row ids in the bitmap, in increasing order
+        """
+        buf = self.bits.to_bytes((self.bits.bit_length() + 7) // 8, "little")
+        if np is not None:
+            return np.flatnonzero(np.unpackbits(np.frombuffer(buf, dtype = np.uint8), bitorder = "little")).tolist()
+        rids = []
+        for i, byte in enumerate(buf):
+            if byte:
+                base = i << 3
+                rids.extend([base + b for b in BYTE_BITS[byte]])
+        return rids
+
+    def __and__(self, other):
+        return Bitmap(self.bits & other.bits)
+
+    def __or__(self, other):
+        return Bitmap(self.bits | other.bits)
+
+    def __sub__(self, other):
+        return Bitmap(self.bits & ~other.bits)
+
+    def __len__(self):
+        return self.bits.bit_count()
+
+    def __bool__(self):
+        return self.bits != 0
+
+def new_column(dtype, key = False):
+    """
+    Creates the storage column for a datatype entry in dtypes,
+    key is True for the primary key column
+    """
+    if "typecode" in dtype:
+        return Column(dtype["typecode"])
+    if key:
+        return KeyColumn()
+    return VarcharColumn()
+# endregion STORAGE #####################################################################
+# region INDEXES ########################################################################
+class SortedIndex:
+    """
+    Secondary index over one column, kept as a sorted array of
+    values with a parallel array of row ids so that range
+    conditions can be answered with bisect.
+    """
+
+    def __init__(self, name, column):
+        self.name = name
+        self.column = column
+        self.values = []
+        self.rids = []
+
+    def build(self, tbl):
+        """
+        Builds the index from every row currently in the table
+
+        Params:
+            tbl: the Table the index belongs to
+        """
+        col = tbl.store[self.column]
+        self.rids = sorted(tbl.row_ids(), key = col.__getitem__)
+        self.values = [col[rid] for rid in self.rids]
+
+    def insert(self, val, rid):
+        i = bisect.bisect_right(self.values, val)
+        self.values.insert(i, val)
+        self.rids.insert(i, rid)
+
+    def insert_many(self, values, rids):
+        """
+        Adds a batch of rows. Only the batch is sorted and each row's place
+        is found by bisecting, with rows of equal value going after the ones
+        already indexed, as insert does. A batch landing in only a few places
+        is spliced in with one slice assignment per place, from the last
+        place back, which moves the entries after it without touching them.
+        A batch spread over many places is merged in one pass instead.
+        """
+        order = sorted(range(len(values)), key = values.__getitem__)
+        places = [bisect.bisect_right(self.values, values[i]) for i in order]
+        groups = [(place, [i for _, i in group]) for place, group in itertools.groupby(zip(places, order), key = lambda p: p[0])]
+        if len(groups) < SORTED_INDEX_SPLICES:
+            for place, group in reversed(groups):
+                self.values[place:place] = [values[i] for i in group]
+                self.rids[place:place] = [rids[i] for i in group]
+            return
+        new_values, new_rids = [], []
+        start = 0
+        for place, group in groups:
+            new_values += self.values[start:place]
+            new_rids += self.rids[start:place]
+            new_values += [values[i] for i in group]
+            new_rids += [rids[i] for i in group]
+            start = place
+        new_values += self.values[start:]
+        new_rids += self.rids[start:]
+        self.values = new_values
+        self.rids = new_rids
+
+    def remove(self, val, rid):
+        i = bisect.bisect_left(self.values, val)
+        j = bisect.bisect_right(self.values, val)
+        i += self.rids[i:j].index(rid)
+        del self.values[i]
+        del self.rids[i]
+
+    def remove_many(self, values, rids):
+        """
+        Drops a batch of rows. A few rows are deleted in place one by one,
+        many in one pass that bisects to the run of each distinct value,
+        filters just that run and copies the entries between runs as slices.
+        """
+        gone = set(rids)
+        if len(gone) < SORTED_INDEX_SPLICES:
+            for val, rid in zip(values, rids):
+                self.remove(val, rid)
+            return
+        new_values, new_rids = [], []
+        start = 0
+        for val in sorted(set(values)):
+            i = bisect.bisect_left(self.values, val, start)
+            j = bisect.bisect_right(self.values, val, i)
+            new_values += self.values[start:i]
+            new_rids += self.rids[start:i]
+            kept = [rid for rid in self.rids[i:j] if rid not in gone]
+            new_values += [val] * len(kept)
+            new_rids += kept
+            start = j
+        new_values += self.values[start:]
+        new_rids += self.rids[start:]
+        self.values = new_values
+        self.rids = new_rids
+
+    def count(self, op, val):
+        """
+        Returns how many rows satisfy "value op val", without fetching them
+        """
+        lo = bisect.bisect_left(self.values, val)
+        hi = bisect.bisect_right(self.values, val)
+        return {"<":lo, "<=":hi, ">":len(self.values) - hi, ">=":len(self.values) - lo, "==":hi - lo,
+                "!=":len(self.values) - hi + lo}[op]
+
+    def lookup(self, op, val):
+        """
+        Returns the row ids whose value satisfies "value op val"
+
+        Params:
+            op: one of "<", "<=", ">", ">=", "==", "!="
+            val: the value to compare against
+        """
+        if op == "<":
+            return self.rids[:bisect.bisect_left(self.values, val)]
+        elif op == "<=":
+            return self.rids[:bisect.bisect_right(self.values, val)]
+        elif op == ">":
+            return self.rids[bisect.bisect_right(self.values, val):]
+        elif op == ">=":
+            return self.rids[bisect.bisect_left(self.values, val):]
+        elif op == "!=":
+            return self.rids[:bisect.bisect_left(self.values, val)] + self.rids[bisect.bisect_right(self.values, val):]
+        return self.rids[bisect.bisect_left(self.values, val):bisect.bisect_right(self.values, val)]
+
+class BitmapIndex:
+    """
+    Secondary index for a low-cardinality column. It has the same
+    value -> rows shape as the column index in Table.table, but keeps
+    each value's rows as a bitmap, so equality and IN conditions become
+    ORs of bitmaps without touching per-row data.
+    """
+
+    def __init__(self, name, column):
+        self.name = name
+        self.column = column
+        self.bitmaps = {}
+
+    def build(self, tbl):
+        """
+        Builds the index from the column store, so a reopened table does
+        not build its column index for it
+
+        Params:
+            tbl: the Table the index belongs to
+        """
+        self.bitmaps = {}
+        rids = tbl.row_ids()
+        for val, rid in zip(tbl.store[self.column].take(rids), rids):
+            self.insert(val, rid)
+
+    def insert(self, val, rid):
+        # Bitmaps are kept as bytearrays so that setting one bit does not copy the whole bitmap
+        bits = self.bitmaps.get(val)
+        if bits is None:
+            bits = self.bitmaps[val] = bytearray()
+        if len(bits) <= rid >> 3:
+            bits.extend(bytes((rid >> 3) + 1 - len(bits)))
+        bits[rid >> 3] |= 1 << (rid & 7)
+
+    def insert_many(self, values, rids):
+        for val, rid in zip(values, rids):
+            self.insert(val, rid)
+
+    def remove(self, val, rid):
+        self.bitmaps[val][rid >> 3] &= ~(1 << (rid & 7)) & 0xFF
+
+    def remove_many(self, values, rids):
+        for val, rid in zip(values, rids):
+            self.remove(val, rid)
+
+    def lookup(self, values):
+        """
+        Returns the Bitmap of rows whose value is any of values
+        """
+        bits = 0
+        for val in set(values):
+            if val in self.bitmaps:
+                bits |= int.from_bytes(self.bitmaps[val], "little")
+        return Bitmap(bits)
+
+class ForeignKeyIndex:
+    """
+    Membership index over a column that foreign keys of child tables
+    reference, kept current with the parent's inserts, updates and deletes
+    like the other secondary indexes. Each value counts its rows, so it
+    stays a member until the last row holding it is gone.
+    """
+
+    def __init__(self, column):
+        self.column = column
+        self.counts = {}
+
+    def __contains__(self, val):
+        return val in self.counts
+
+    def build(self, tbl):
+        """
+        Builds the index from the stored column alone, leaving the
+        table's column indexes unbuilt if they have not been needed yet
+
+        Params:
+            tbl: the Table the index belongs to
+        """
+        self.counts = dict(Counter(tbl.store[self.column].take(tbl.row_ids())))
+
+    def insert(self, val, rid):
+        self.counts[val] = self.counts.get(val, 0) + 1
+
+    def insert_many(self, values, rids):
+        for val in values:
+            self.counts[val] = self.counts.get(val, 0) + 1
+
+    def remove(self, val, rid):
+        n = self.counts.pop(val) - 1
+        if n:
+            self.counts[val] = n
+
+    def remove_many(self, values, rids):
+        for val in values:
+            self.remove(val, None)
+
+    def missing(self, values):
+        """
+        Returns the set of values that no row holds, with one set difference
+        """
+        return set(values).difference(self.counts)
+
+def create_index(tokens, bitmap = False):
+    """
+    Function to create a sorted index, e.g. "create index idx on df2 (year)",
+    or a bitmap index, e.g. "create bitmap index idx on df1 (Color)"
+
+    Params:
+        tokens: the tokenized command, without the leading "create [bitmap] index"
+        bitmap: if True, create a BitmapIndex instead of a SortedIndex
+    """
+    cmd = " ".join(tokens)
+    if " on " not in f" {cmd.lower()} " or "(" not in cmd:
+        print("ERROR: create index query not properly formatted")
+        return 1
+    name = tokens[0]
+    target = cmd[cmd.lower().index(" on ")+4:]
+    df = target.split("(")[0].strip()
+    col = target.split("(")[1].split(")")[0].strip()
+
+    if df not in TABLES:
+        print(f"ERROR: table {df} does not exist")
+        return 1
+    if col not in TABLES[df].columns:
+        print(f"ERROR: column {col} does not exist in table {df}")
+        return 1
+
+    if bitmap:
+        index = BitmapIndex(name, col)
+        index.build(TABLES[df])
+        TABLES[df].bitmap_indexes[col] = index
+    else:
+        index = SortedIndex(name, col)
+        index.build(TABLES[df])
+        TABLES[df].indexes[col] = index
+    return 0
+
+# Map the ast comparison nodes that a sorted index can answer to
+# their operator, and to the operator with the sides swapped
+INDEX_OPS = {
+    ast.Lt:("<",">"),
+    ast.LtE:("<=",">="),
+    ast.Gt:(">","<"),
+    ast.GtE:(">=","<="),
+    ast.Eq:("==","=="),
+    ast.NotEq:("!=","!=")
+}
+
+def index_range(cond, var):
+    """
+    Checks whether a single-variable condition is a plain comparison
+    between the variable and a constant, e.g. "b___year < 1910"
+
+    Params:
+        cond: the condition string, with "." in column names replaced by "___"
+        var: the variable name in the condition
+
+    Return:
+        (operator, constant) tuple, or None if an index cannot answer it
+    """
+    node = ast.parse(cond, mode = "eval").body
+    if not isinstance(node, ast.Compare) or len(node.ops) != 1 or type(node.ops[0]) not in INDEX_OPS:
+        return None
+    left, right = node.left, node.comparators[0]
+    ops = INDEX_OPS[type(node.ops[0])]
+    if isinstance(left, ast.Name) and left.id == var:
+        op, const = ops[0], right
+    elif isinstance(right, ast.Name) and right.id == var:
+        op, const = ops[1], left
+    else:
+        return None
+    if any(isinstance(n, ast.Name) for n in ast.walk(const)):
+        return None
+    try:
+        return op, eval(compile(ast.Expression(const), filename = "<where>", mode = "eval"), {})
+    except Exception:
+        return None
+# endregion INDEXES #####################################################################
+
+# region LOADING ########################################################################
+def cast_rows(rows, name, columns, dtypes):
+    """
+    Function for casting a chunk of parsed lines into column lists,
+    one whole column at a time
+
+    Params:
+        rows: list of lists of field strings
+        name: name of the target table, for error messages
+        columns: the column names of the target table
+        dtypes: the column -> data type dictionary of the target table
+
+    Return:
+        (dictionary of column -> cast values, error message or "") where the
+        columns stop before the first line that could not be cast
+    """
+    error = ""
+    if rows and min(map(len, rows)) < len(columns):
+        short = next(i for i, line in enumerate(rows) if len(line) < len(columns))
+        error = f"ERROR: row insert of length {len(rows[short])} does not match {name} column number of {len(columns)}"
+        rows = rows[:short]
+
+    fields = list(zip(*rows)) if rows else [()] * len(columns)
+    batch = {}
+    n = len(rows)
+    for col, data in zip(columns, fields):
+        cast = dtypes[col]["cast"]
+        try:
+            values = list(map(cast, data))
+        except ValueError:
+            values = []
+            for field in data:
+                try:
+                    values.append(cast(field))
+                except ValueError:
+                    break
+            if len(values) < n:
+                n = len(values)
+                error = f"ERROR: cannot convert value {data[n]} to type {cast}"
+        if "size" in dtypes[col]:
+            size = dtypes[col]["size"]
+            values = [v[:size] for v in values]
+        batch[col] = values
+    return {col:batch[col][:n] for col in batch}, error
+
+def line_end(f, pos, terminator):
+    """
+    Function for finding the byte offset just past the next line terminator
+    at or after pos, or the end of the file if there is none
+
+    Params:
+        f: the input file opened in binary mode
+        pos: the byte offset to search from
+        terminator: the line terminator as bytes
+    """
+    f.seek(pos)
+    buf = b""
+    while True:
+        block = f.read(1 << 16)
+        if not block:
+            return pos + len(buf)
+        buf += block
+        i = buf.find(terminator)
+        if i != -1:
+            return pos + i + len(terminator)
+
+def read_lines(f, line_delimeter):
+    """
+    Generator over the lines of a file opened with newline="", split on the
+    LINES TERMINATED BY string exactly as parse_range splits a byte range,
+    so a file loads the same with and without load workers
+    """
+    rest = ""
+    while True:
+        block = f.read(1 << 16)
+        if not block:
+            break
+        lines = (rest + block).split(line_delimeter)
+        rest = lines.pop()
+        yield from lines
+    if rest:
+        yield rest
+
+def load_ranges(file, ignore, line_delimeter, workers):
+    """
+    Function for splitting a file into byte ranges that each start and end on a
+    line boundary, after skipping the ignored rows. There are at least as many
+    ranges as workers and none much larger than PARALLEL_LOAD_BYTES
+
+    Return:
+        list of (start, end) byte offsets
+    """
+    terminator = line_delimeter.encode()
+    size = os.path.getsize(file)
+    with open(file, "rb") as f:
+        start = 0
+        for _ in range(ignore):
+            start = line_end(f, start, terminator)
+        count = max(workers, math.ceil((size - start) / PARALLEL_LOAD_BYTES))
+        step = max((size - start) // count, 1)
+        bounds = [start]
+        for i in range(1, count):
+            if bounds[-1] >= size:
+                break
+            bounds.append(line_end(f, max(start + i * step, bounds[-1]), terminator))
+    if bounds[-1] < size:
+        bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if a < b]
+
+def parse_range(args):
+    """
+    Function run in a load worker process: parses and casts one byte range
+    of the input file, and builds the range's fragment of the column indexes
+
+    Params:
+        args: (file, start, end, col_delimeter, line_delimeter, name, columns, dtypes, key)
+
+    Return:
+        (the cast batch and error from cast_rows, dictionary of non-key
+        column -> value -> offsets of the rows in the batch holding it)
+    """
+    file, start, end, col_delimeter, line_delimeter, name, columns, dtypes, key = args
+    with open(file, "rb") as f:
+        f.seek(start)
+        lines = f.read(end - start).decode("utf-8").split(line_delimeter)
+    if lines[-1] == "":
+        lines.pop()
+    batch, error = cast_rows(list(csv.reader(lines, delimiter=col_delimeter)), name, columns, dtypes)
+    postings = {}
+    for col in columns:
+        if col == key:
+            continue
+        fragment = postings[col] = {}
+        for i, val in enumerate(batch[col]):
+            offsets = fragment.get(val)
+            if offsets is None:
+                fragment[val] = [i]
+            else:
+                offsets.append(i)
+    return batch, error, postings
+# endregion LOADING #####################################################################
+
 class Table:
     """
     Class definition for each table that will exist within out relation
@@ -50,12 +811,189 @@ class Table:
         self.nrow = 0
         self.ncol = len(col_dtype_dict)
         self.name = name
-        
+        # Bumped on every change to the rows, so cached results can tell they are stale
+        self.version = 0
+
+        # Row data lives in one typed column per table column, addressed
+        # by dense row ids. self.live marks which row ids have not been deleted.
+        self.store = {col:new_column(self.dtypes[col], col == self.key) for col in self.dtypes}
+        self.live = bytearray()
+
+        # Column indexes: the key column maps key -> row id,
+        # every other column maps value -> list of row ids. Deleted row ids
+        # stay in the lists until the list is next read, self.stale counts
+        # them per column and value.
         self.table = {}
+        self.stale = {col:{} for col in self.columns}
         for col in self.dtypes:
             self.table[col] = {}
+
+        # Sorted secondary indexes, by column, made with "create index",
+        # and bitmap indexes, by column, made with "create bitmap index"
+        self.indexes = {}
+        self.bitmap_indexes = {}
+        self.fk_indexes = {}
+
+        # Column statistics, by column, collected with "analyze table"
+        self.stats = {}
+
+        # Loaders for attributes that a table reopened with "open table"
+        # builds on first use, by attribute name, and the saved distinct
+        # value counts that stand in for the column indexes until then
+        self.pending = {}
+        self.saved_distinct = {}
         return
 
+    def __getattr__(self, name):
+        pending = self.__dict__.get("pending")
+        if not pending or name not in pending:
+            raise AttributeError(name)
+        setattr(self, name, pending.pop(name)())
+        return self.__dict__[name]
+
+    def live_bitmap(self):
+        """
+        Returns a Bitmap of every row currently in the table
+        """
+        if np is not None:
+            return Bitmap.from_mask(np.frombuffer(self.live, dtype = np.uint8) != 0)
+        return Bitmap.from_rids(self.row_ids())
+
+    def loaded_index(self, col, kind = "indexes"):
+        """
+        Returns the sorted ("indexes") or bitmap ("bitmap_indexes") index on
+        a column, or None if there is none or the table was reopened and has
+        not built that kind of index yet. The planner asks through here so
+        that costing a query does not build indexes.
+        """
+        if kind in self.pending:
+            return None
+        return getattr(self, kind).get(col)
+
+    def indexes_on(self, col):
+        """
+        Returns the secondary indexes that must be kept current when col changes
+        """
+        return [index for index in [self.indexes.get(col), self.bitmap_indexes.get(col), self.fk_indexes.get(col)] if index is not None]
+
+    def foreign_key_index(self, col):
+        """
+        Returns the ForeignKeyIndex of a column that child tables reference,
+        building it the first time a child row is checked against it
+        """
+        index = self.fk_indexes.get(col)
+        if index is None:
+            index = self.fk_indexes[col] = ForeignKeyIndex(col)
+            index.build(self)
+        return index
+
+    def row_ids(self):
+        """
+        Returns the row ids of every row currently in the table
+        """
+        return list(itertools.compress(range(len(self.live)), self.live))
+
+    def distinct(self, col):
+        """
+        Returns the number of distinct values in a column
+        """
+        if "table" in self.pending:
+            return self.saved_distinct[col]
+        return len(self.table[col])
+
+    def rows_with(self, col, val):
+        """
+        Returns the row ids whose col equals val, using the column index
+        """
+        if col == self.key:
+            return [self.table[col][val]] if val in self.table[col] else []
+        if val in self.stale[col]:
+            self.compact(col)
+        return self.table[col].get(val, [])
+
+    def compact(self, col):
+        """
+        Member function for dropping the deleted row ids from the value -> row ids
+        lists of a column, in one pass over each list that holds any
+        """
+        index = self.table[col]
+        for val in self.stale[col]:
+            rids = index[val]
+            rids[:] = itertools.compress(rids, map(self.live.__getitem__, rids))
+        self.stale[col] = {}
+
+    def analyze(self):
+        """
+        Member function for collecting the per-column statistics used by
+        the planner: row count, distinct count, min/max and an equi-depth
+        histogram, given as the HISTOGRAM_BUCKETS+1 bucket boundaries.
+        """
+        self.stats = {}
+        for col in self.columns:
+            if col in self.indexes:
+                values = self.indexes[col].values
+            else:
+                values = sorted(self.store[col][rid] for rid in self.row_ids())
+            n = len(values)
+            self.stats[col] = {
+                "rows":n,
+                "distinct":len(self.table[col]),
+                "min":values[0] if n else None,
+                "max":values[-1] if n else None,
+                "histogram":[values[(i * (n - 1)) // HISTOGRAM_BUCKETS] for i in range(HISTOGRAM_BUCKETS + 1)] if n else []
+            }
+
+    def memory_usage(self):
+        """
+        Member function for measuring how many bytes the row data, the
+        column indexes and the foreign key indexes take in the columnar
+        storage, compared with keeping a column:value dictionary for every
+        row keyed by the primary key next to value -> list of keys indexes
+        on the other columns.
+        Objects held by several containers, like a string that is both a
+        row value and an index key, are counted once.
+
+        Return:
+            dictionary of byte counts for the "columnar" and "row dicts" layouts
+        """
+        seen = set()
+        def size(obj):
+            if id(obj) in seen:
+                return 0
+            seen.add(id(obj))
+            return sys.getsizeof(obj)
+
+        columnar = sum(self.store[col].nbytes() for col in self.columns) + sys.getsizeof(self.live)
+        for col in self.columns:
+            store = self.store[col]
+            if isinstance(store, KeyColumn):
+                seen.update(map(id, store.data))
+            elif isinstance(store, VarcharColumn):
+                seen.update(map(id, store.dictionary))
+        for col in self.columns:
+            columnar += sys.getsizeof(self.table[col])
+            for val, rids in self.table[col].items():
+                columnar += size(val)
+                if col == self.key:
+                    columnar += size(rids)
+                else:
+                    columnar += sys.getsizeof(rids) + sum(map(size, rids))
+        for index in self.fk_indexes.values():
+            columnar += sys.getsizeof(index.counts) + sum(map(size, index.counts))
+
+        # Every index list holds keys of the row dictionaries and every
+        # index key is a value of some row, so only the containers add up
+        row_dicts = sys.getsizeof({k:None for k in self.table[self.key]}) if self.key else 0
+        for rid in self.row_ids():
+            row = {col:self.store[col][rid] for col in self.columns if col != self.key}
+            row_dicts += sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row.values())
+            if self.key:
+                row_dicts += sys.getsizeof(self.store[self.key][rid])
+        for col in self.columns:
+            if col != self.key:
+                row_dicts += sys.getsizeof(self.table[col]) + sum(map(sys.getsizeof, self.table[col].values()))
+        return {"columnar":columnar, "row dicts":row_dicts}
+
     def insert(self, row_dict):
         """
         Member function for insertion into the table. This will insert
@@ -73,54 +1011,251 @@ class Table:
             print(f"ERROR: row insert of length {len(row_dict)} does not match {self.name} column number of {self.ncol}")
             return 1
         
+        # Make sure that every column exists in the table
         for col in row_dict:
-
-            try:
-                row_dict[col] = self.dtypes[col]["cast"](row_dict[col])
-            except ValueError:
-                print(f"ERROR: cannot convert value {row_dict[col]} to type {self.dtypes[col]['cast']}")
+            if col not in self.columns:
+                print(f"ERROR: insert column {col} does not exist in {self.name}")
                 return 1
 
+        # Cast the same way as a multi-row insert or a load
+        batch, error = cast_rows([[row_dict[col] for col in self.columns]], self.name, self.columns, self.dtypes)
+        if error:
+            print(error)
+            return 1
+        row_dict = {col:batch[col][0] for col in self.columns}
+
+        for col in row_dict:
             # If the column is a foreign key, make sure that 
             # no duplicates exist in the referred-to column
             if col in self.f_keys:
-                if row_dict[col] not in TABLES[self.f_keys[col]["table"]].table[self.f_keys[col]["col"]]:
+                if row_dict[col] not in TABLES[self.f_keys[col]["table"]].foreign_key_index(self.f_keys[col]["col"]):
                     print(f"ERROR: attempting to insert value {row_dict[col]} that does not exist in foreign key table {self.f_keys[col]['table']}, column {self.f_keys[col]['col']}")
                     return 1
             
-            # Make sure that the column exists in the table
-            if col not in self.columns:
-                print(f"ERROR: insert column {col} does not exist in {self.name}")
-                return 1
-            
             # If the column is this table's key, make sure that
             # no duplicates exist in the column
             if col == self.key and row_dict[col] in self.table[col]:
                 print(f"ERROR: trying to insert duplicate value {row_dict[col]} into column {col}")
                 return 1
 
+        # Every check passed, so the row can be appended to
+        # the column arrays and registered in the column indexes
+        rid = len(self.live)
+        try:
+            for col in self.columns:
+                self.store[col].append(row_dict[col])
+        except OverflowError:
+            print(f"ERROR: value {row_dict[col]} is out of range for column {col}")
+            for c in self.columns:
+                if len(self.store[c]) > rid:
+                    self.store[c].pop()
+            return 1
+        self.live.append(1)
+
+        for col in self.columns:
             if col != self.key:
                 if row_dict[col] not in self.table[col]:
                     self.table[col][row_dict[col]] = []
-                self.table[col][row_dict[col]].append(row_dict[self.key])
+                self.table[col][row_dict[col]].append(rid)
             else:
-                self.table[col][row_dict[col]] = {k:v for k,v in row_dict.items() if k != col}
+                self.table[col][row_dict[col]] = rid
+            for index in self.indexes_on(col):
+                index.insert(row_dict[col], rid)
 
         self.nrow += 1
+        self.version += 1
         return 0
 
-    def empty(self):
-        self.table = {col:{} for col in self.columns}
-        for col in self.child_keys:
-            TABLES[self.child_keys[col]["table"]].empty()
-
-    def import_file(self, tkns):
+    def insert_many(self, batch, defer_indexes = False, postings = None, atomic = False):
         """
-        Member function for importing from a file
+        Member function for inserting a batch of already-cast rows. Primary-key
+        uniqueness and foreign keys are checked once for the whole batch with
+        set operations, and each column array is extended in one call. Like
+        chained insert calls, the rows before the first invalid row are kept,
+        unless the batch is atomic.
 
-        Params: 
-            tkns: the tokenized version of the input command
-        """
+        Params:
+            batch: dictionary of column -> list of values, one per row
+            defer_indexes: if True, leave the sorted and bitmap indexes
+                for a later build_indexes call, otherwise add the batch
+                to them with one insert_many call each
+            postings: the batch's column index fragments from parse_range,
+                merged in place of indexing the rows one by one
+            atomic: if True, insert nothing when any row is invalid
+
+        Return:
+            1 if error else 0
+        """
+        n = len(batch[self.columns[0]])
+        bad = n
+        error = ""
+
+        # One duplicate check for the batch, scanning for the
+        # offending row only if the set check fails
+        if self.key:
+            keys = batch[self.key]
+            existing = self.table[self.key]
+            if len(set(keys)) != n or not existing.keys().isdisjoint(keys):
+                seen = set()
+                for i, k in enumerate(keys):
+                    if k in existing or k in seen:
+                        bad = i
+                        error = f"ERROR: trying to insert duplicate value {k} into column {self.key}"
+                        break
+                    seen.add(k)
+
+        # One membership check per distinct foreign key value
+        for col in self.f_keys:
+            if not col:
+                continue
+            parent = TABLES[self.f_keys[col]["table"]].foreign_key_index(self.f_keys[col]["col"])
+            missing = parent.missing(batch[col][:bad])
+            if missing:
+                i = next(i for i, val in enumerate(batch[col]) if val in missing)
+                bad = i
+                error = f"ERROR: attempting to insert value {batch[col][i]} that does not exist in foreign key table {self.f_keys[col]['table']}, column {self.f_keys[col]['col']}"
+
+        if bad < n and atomic:
+            print(error)
+            return 1
+        if bad < n:
+            batch = {col:batch[col][:bad] for col in self.columns}
+            n = bad
+            postings = None
+
+        start = len(self.live)
+        try:
+            for col in self.columns:
+                self.store[col].extend(batch[col])
+        except OverflowError:
+            print(f"ERROR: value out of range for column {col}")
+            for c in self.columns:
+                self.store[c].truncate(start)
+            return 1
+        self.live.extend(b"\x01" * n)
+        self.nrow += n
+        self.version += 1
+
+        if postings is None:
+            self.index_rows(self.table, range(start, start + n), batch)
+        else:
+            self.merge_postings(start, batch, postings)
+        if not defer_indexes:
+            for col in self.columns:
+                for index in self.indexes_on(col):
+                    index.insert_many(batch[col], range(start, start + n))
+
+        if error:
+            print(error)
+            return 1
+        return 0
+
+    def insert_rows(self, columns, rows):
+        """
+        Member function for inserting the rows of a multi-row insert as one
+        batch. The values are cast a column at a time and validated with
+        insert_many. Like any single statement the insert is all or nothing,
+        so an invalid row leaves the table unchanged.
+
+        Params:
+            columns: the column names, in the order the values are given
+            rows: list of lists of value strings, one per row
+
+        Return:
+            1 if error else 0
+        """
+        if sorted(columns) != sorted(self.columns):
+            print(f"ERROR: insert columns {', '.join(columns)} do not match the columns of {self.name}")
+            return 1
+        order = [columns.index(col) for col in self.columns]
+        batch, error = cast_rows([[row[i] for i in order] for row in rows], self.name, self.columns, self.dtypes)
+        if error:
+            print(error)
+            return 1
+        return self.insert_many(batch, atomic = True)
+
+    def index_rows(self, table, rids, batch):
+        """
+        Member function for registering rows in the column indexes
+
+        Params:
+            table: the column indexes to add to, normally self.table
+            rids: the row ids of the rows
+            batch: dictionary of column -> list of values, one per row id
+        """
+        for col in self.columns:
+            index = table[col]
+            if col == self.key:
+                index.update(zip(batch[col], rids))
+                continue
+            for rid, val in zip(rids, batch[col]):
+                posting = index.get(val)
+                if posting is None:
+                    index[val] = [rid]
+                else:
+                    posting.append(rid)
+
+    def merge_postings(self, start, batch, postings):
+        """
+        Member function for adding the column index fragments built by load
+        workers, whose offsets count from the first row of the batch
+
+        Params:
+            start: the row id of the first row of the batch
+            batch: dictionary of column -> list of values, one per row
+            postings: dictionary of non-key column -> value -> offsets
+        """
+        if self.key:
+            self.table[self.key].update(zip(batch[self.key], itertools.count(start)))
+        for col, fragment in postings.items():
+            index = self.table[col]
+            for val, offsets in fragment.items():
+                rids = [start + i for i in offsets]
+                posting = index.get(val)
+                if posting is None:
+                    index[val] = rids
+                else:
+                    posting.extend(rids)
+
+    def build_column_indexes(self):
+        """
+        Member function for building the column indexes from the stored rows
+
+        Return:
+            dictionary of column -> column index, in the layout of self.table
+        """
+        table = {col:{} for col in self.columns}
+        rids = self.row_ids()
+        self.index_rows(table, rids, {col:list(map(self.store[col].__getitem__, rids)) for col in self.columns})
+        return table
+
+    def build_indexes(self):
+        """
+        Member function for rebuilding the sorted, bitmap and foreign key
+        indexes of the table in one pass each, used after a bulk load
+        """
+        for index in list(self.indexes.values()) + list(self.bitmap_indexes.values()) + list(self.fk_indexes.values()):
+            index.build(self)
+
+    def empty(self):
+        self.table = {col:{} for col in self.columns}
+        self.store = {col:new_column(self.dtypes[col], col == self.key) for col in self.columns}
+        self.live = bytearray()
+        self.nrow = 0
+        self.version += 1
+        self.stale = {col:{} for col in self.columns}
+        for index in list(self.indexes.values()) + list(self.bitmap_indexes.values()) + list(self.fk_indexes.values()):
+            index.build(self)
+        for col in self.child_keys:
+            TABLES[self.child_keys[col]["table"]].empty()
+
+    def import_file(self, tkns):
+        """
+        Member function for importing from a file
+
+        Params: 
+            tkns: the tokenized version of the input command
+        """
 
         file = ""
         col_delimeter = ","
@@ -140,142 +1275,232 @@ class Table:
             except IndexError:
                 pass
         
-        # Read in each line of the file and then
-        # use the insert command to add them to the table
-        with open(file, "r") as f:
-            reader = csv.reader(f, delimiter=col_delimeter, lineterminator=line_delimeter)
-            i = 0
-            for line in reader:
-                i += 1
-                if i > ignore:
-                    new_row = {}
-                    for col, data in zip(self.columns, line):
-                        add = self.dtypes[col]["cast"](data)
-                        if "size" in self.dtypes[col]:
-                            add = add[:self.dtypes[col]["size"]]
-                        new_row[col] = add
-                    if self.insert(new_row) == 1:
+        line_delimeter = codecs.decode(line_delimeter, "unicode_escape")
+        self.version += 1
+        workers = SETTINGS["load_workers"]
+        if workers > 1 and os.path.getsize(file) >= PARALLEL_LOAD_BYTES:
+            # Split the file into line-aligned byte ranges, and parse, cast and
+            # build column index fragments for them in a process pool. The
+            # ranges come back in file order and are inserted as they arrive,
+            # so the first bad row still stops the load with every row before it kept
+            jobs = [(file, a, b, col_delimeter, line_delimeter, self.name, self.columns, self.dtypes, self.key)
+                    for a, b in load_ranges(file, ignore, line_delimeter, workers)]
+            with multiprocessing.Pool(workers) as pool:
+                for batch, error, postings in pool.imap(parse_range, jobs):
+                    if self.insert_many(batch, defer_indexes = True, postings = postings) == 1:
                         break
+                    if error:
+                        print(error)
+                        break
+            self.build_indexes()
+            return
+
+        # Read the file in chunks of lines, cast each chunk a whole
+        # column at a time and insert it as one batch. The sorted and
+        # bitmap indexes are rebuilt in one pass once the file is loaded
+        with open(file, "r", encoding = "utf-8", newline = "") as f:
+            reader = csv.reader(read_lines(f, line_delimeter), delimiter=col_delimeter)
+            for _ in itertools.islice(reader, ignore):
+                pass
+            while True:
+                rows = list(itertools.islice(reader, BULK_BATCH_ROWS))
+                if not rows:
+                    break
+                batch, error = cast_rows(rows, self.name, self.columns, self.dtypes)
+                if self.insert_many(batch, defer_indexes = True) == 1:
+                    break
+                if error:
+                    print(error)
+                    break
+        self.build_indexes()
         return
 
-    def update(self, tokens):
+    def update(self, tokens, params = None):
         """
         Member function for updating values in the table.
 
         Params:
             tkns: the tokenized version of the input command
+            params: values bound to parameter markers in the where clause
         """
 
-        cmd_sects = {
-            "df":"",
-            "set":"",
-            "where":""
-        }
-        key = ""
-        for t in tokens:
-            if t.lower() == "update":
-                key = "df"
-            elif t.lower() == "set":
-                key = "set"
-            elif t.lower() == "where":
-                key = "where"
-            else:
-                cmd_sects[key] += t + " "
-        
-        cols = [c.split("=")[0].strip() for c in cmd_sects["set"].split(",")]
+        parsed = parse_update(tokens)
+        if parsed is None:
+            print("ERROR: update query not properly formatted")
+            return 1
+        _, sets, where = parsed
+        cols = [col for col, _ in sets]
         
         if any([c == self.key for c in cols]):
             # Checks to make sure you are not trying to update a primary key column
             print("ERROR: trying to update value in primary key column")
+        elif any(c not in self.dtypes for c in cols):
+            print(f"ERROR: column {[c for c in cols if c not in self.dtypes][0]} does not exist in table {self.name}")
         else:
             # Get the values that need to be assigned
-            assigns = [c.split("=")[1].strip() for c in cmd_sects["set"].split(",")]
+            assigns = [val for _, val in sets]
+            cont = True
             for i in range(len(assigns)):
                 try:
                     assigns[i] = self.dtypes[cols[i]]["cast"](assigns[i])
-                    cont = True
                 except ValueError:
                     cont = False
                     print(f"ERROR: cannot convert value of type {type(assigns[i])} to {self.dtypes[cols[i]]['cast']}")
 
-            
             # If the datatype conversion is acceptable, then actually update
-            if cont:  
-                # This part basically just runs a select-query and then
-                # gets the keys from thr returned table to then update
-                assign_dict = {old:new for old, new in zip(cols, assigns)}
-                select = f"select {', '.join(cols)} from {cmd_sects['df'].strip()} where {cmd_sects['where'].strip()}"
-                subset_vals = process_select(select, do_print=False)
-
-                # For each column in the returned, conditioned table...
-                for col in assign_dict:
-
-                    # If the update value is not in the table-column index,
-                    # create an empty table
-                    if assign_dict[col] not in self.table[col]:
-                        self.table[col][assign_dict[col]] = []
-
-                    # For each value in the subset values,
-                    # add the associated keys to the list for the
-                    # replacement value and then pop the value
-                    # from the column index if it is not the replacement value.
-                    for val in subset_vals[col]:
-                        val = self.dtypes[col]["cast"](val)
-                        self.table[col][assign_dict[col]] += self.table[col][val].copy()
-                        if val != assign_dict[col]:
-                            self.table[col].pop(val)
-                    
-                    # For each key in that new list, make sure that the 
-                    # corresponding value in the primary key index is
-                    # also correctly updated.
-                    for key in self.table[col][assign_dict[col]]:
-                        self.table[self.key][key][col] = assign_dict[col]
+            # the rows that satisfy the where clause
+            if cont:
+                return self.update_where(dict(zip(cols, assigns)), where, params)
+        return 1
 
-    def delete(self, tokens):
+    def update_where(self, assign_dict, where, params = None):
+        """
+        Member function for setting columns of the rows that satisfy a where
+        clause, evaluating the where clause once
+
+        Params:
+            assign_dict: dictionary of column -> new, already cast, value
+            where: the text of the where clause, or "" for every row
+            params: values bound to parameter markers in the where clause
+
+        Return:
+            1 if error else 0
+        """
+        # Every new value is checked before any row or index changes
+        for col, new in assign_dict.items():
+            if not self.store[col].fits(new):
+                print(f"ERROR: value {new} is out of range for column {col}")
+                return 1
+        rids = where_rows(self.name, where, params) if where else self.row_ids()
+        for col, new in assign_dict.items():
+            self.update_rows(col, rids, new)
+        self.version += 1
+        return 0
+
+    def update_rows(self, col, rids, new):
+        """
+        Member function for setting one column of a batch of rows to a new
+        value. The row ids leave the value -> row ids list of each old value
+        in one pass per list, and the sorted and bitmap indexes are patched
+        for just the rows that change.
+
+        Params:
+            col: the column to set
+            rids: the row ids to update
+            new: the new, already cast, value
+        """
+        column = self.store[col]
+        moved = [(old, rid) for old, rid in zip(column.take(rids), rids) if old != new]
+        if not moved:
+            return
+        olds = [old for old, _ in moved]
+        rids = [rid for _, rid in moved]
+
+        self.compact(col)
+        index = self.table[col]
+        by_value = {}
+        for old, rid in moved:
+            by_value.setdefault(old, set()).add(rid)
+        for old, gone in by_value.items():
+            kept = [rid for rid in index[old] if rid not in gone]
+            if kept:
+                index[old] = kept
+            else:
+                index.pop(old)
+        # the new value's row ids stay in row id order
+        posting = index.get(new)
+        index[new] = rids if posting is None else sorted(posting + rids)
+
+        for rid in rids:
+            column[rid] = new
+        for idx in self.indexes_on(col):
+            idx.remove_many(olds, rids)
+            idx.insert_many([new] * len(rids), rids)
+
+    def delete(self, tokens, params = None):
         """
         Member function for deleting values in the table. This
         incorporates cascading deletion.
 
         Params:
             tokens: the tokenized version of the input command
+            params: values bound to parameter markers in the where clause
         """
 
         # Similar to update, just processes the conditional statement
         # with the selection function and then handles the returned keys
         where = " ".join(tokens[2:]).split(",")
         select_command = f"select {self.key} from {self.name} where {', '.join(where)}"
-        keys = process_select(select_command, False)
+        keys = process_select(select_command, False, params=params)
 
         if not keys[self.key]:
             print(f"ERROR: no values match delete condition")
         else:
-            # For each key in the key column of the delete-list
-            for key in keys[self.key]:
-                # For each column in the table
-                for col in self.table[self.key][key]:
-                    val = self.table[self.key][key][col]
-
-                    # remove the key from the corresponding value list
-                    self.table[col][val].remove(key)
-
-                    # If the column has a child-list,
-                    # then call the delete member function 
-                    # for the table that references
-                    if col in self.child_keys:
-                        tbl = self.child_keys[col]["table"]
-                        c = self.child_keys[col]["col"]
-
-                        TABLES[tbl].delete([tbl,"where",c,"==",str(val)])
-                
-                # If the key column has a child-list,
-                # do the same as with the columns.
-                if self.key in self.child_keys:
-                    tbl = self.child_keys[self.key]["table"]
-                    c = self.child_keys[self.key]["col"]
-                    TABLES[tbl].delete([tbl,"where",c,"==",str(val)])
-                
-                # Remove the key value from the primary-key column
-                self.table[self.key].pop(key)
+            self.cascade_delete([self.table[self.key][key] for key in keys[self.key]])
+
+    def cascade_delete(self, rids):
+        """
+        Member function for deleting rows together with the rows of child
+        tables that reference them, breadth first. Each level collects the
+        distinct values its deleted rows held in every column with a
+        child-list, and deletes the child rows holding any of them as one
+        batch, found with one column index lookup per value.
+
+        Params:
+            rids: the row ids to delete from this table
+        """
+        queue = deque([(self, rids)])
+        while queue:
+            tbl, rids = queue.popleft()
+            # a row reached twice through the cascade is only deleted once
+            rids = [rid for rid in dict.fromkeys(rids) if tbl.live[rid]]
+            if not rids:
+                continue
+
+            # The values that child tables reference are read before the rows go
+            cascades = [(child, set(tbl.store[col].take(rids))) for col, child in tbl.child_keys.items()]
+            tbl.delete_rows(rids)
+
+            for child, values in cascades:
+                child_tbl = TABLES[child["table"]]
+                child_rids = [rid for val in values for rid in child_tbl.rows_with(child["col"], val)]
+                if child_rids:
+                    queue.append((child_tbl, child_rids))
+
+    def delete_rows(self, rids):
+        """
+        Member function for removing a batch of rows in one pass per column.
+        The value -> row ids lists only count the deleted row ids as stale,
+        which is O(1) per row, and are compacted when next read; a value
+        whose rows are all deleted is dropped at once. The sorted and bitmap
+        indexes drop the whole batch together.
+
+        Params:
+            rids: the row ids to delete
+        """
+        for col in self.columns:
+            values = list(self.store[col].take(rids))
+            index = self.table[col]
+            if col == self.key:
+                for val in values:
+                    index.pop(val)
+            else:
+                stale = self.stale[col]
+                for val, n in Counter(values).items():
+                    n += stale.get(val, 0)
+                    if n == len(index[val]):
+                        index.pop(val)
+                        stale.pop(val, None)
+                    else:
+                        stale[val] = n
+            for idx in self.indexes_on(col):
+                idx.remove_many(values, rids)
+
+        # tombstone the row ids in the column storage
+        for rid in rids:
+            self.live[rid] = 0
+        self.nrow -= len(rids)
+        self.version += 1
 
     # def print_table(self, rows = float("inf")):
     #     output = []
@@ -367,6 +1592,688 @@ def create_table(cmd):
     
     return name, Table(name, columns, primary_key, foreigns)
 
+def memory_report():
+    """
+    Function to print the memory used by each table's row data and indexes
+    """
+    table = PrettyTable()
+    table.field_names = ["table", "rows", "row dicts (bytes)", "columnar (bytes)", "ratio"]
+    for name in TABLES:
+        usage = TABLES[name].memory_usage()
+        ratio = usage["row dicts"] / usage["columnar"] if usage["columnar"] else 0
+        table.add_row([name, TABLES[name].nrow, usage["row dicts"], usage["columnar"], f"{ratio:.1f}x"])
+    print(table)
+
+def table_file(tokens):
+    """
+    Function to get the table name and file path of a "save table" or
+    "open table" command, e.g. "df1" or "df1 'path/df1.tbl'". The file
+    defaults to <name>.tbl, and a lone quoted path names the table by
+    its saved name.
+    """
+    if not tokens:
+        return "", ""
+    if tokens[0].startswith("'"):
+        return "", tokens[0].strip("'")
+    if len(tokens) > 1:
+        return tokens[0], tokens[-1].strip("'")
+    return tokens[0], f"{tokens[0]}.tbl"
+
+def save_table(tokens):
+    """
+    Function to write a table to a binary column file, e.g. "save table df1 'df1.tbl'"
+
+    The file is TABLE_FILE_MAGIC, the length of a JSON schema header, the header,
+    then 8-byte aligned pages: the live row flags, one raw typed array per numeric
+    column, and for each varchar column its codes array and a JSON dictionary page.
+    The header holds the byte offset and length of every page.
+
+    Params:
+        tokens: the tokenized command, without the leading "save table"
+    """
+    name, path = table_file(tokens)
+    if name not in TABLES:
+        print(f"ERROR: table {name} does not exist")
+        return 1
+    tbl = TABLES[name]
+
+    pages = []
+    offset = 0
+    def add_page(data):
+        nonlocal offset
+        data = memoryview(data).cast("B")
+        pages.append(data)
+        page = [offset, data.nbytes]
+        offset += data.nbytes + (-data.nbytes % 8)
+        return page
+
+    header = {
+        "name":name,
+        "key":tbl.key,
+        "f_keys":tbl.f_keys,
+        "child_keys":tbl.child_keys,
+        "nrow":tbl.nrow,
+        "dtypes":{},
+        "pages":{"live":add_page(tbl.live)},
+        "indexes":{col:index.name for col, index in tbl.indexes.items()},
+        "bitmap_indexes":{col:index.name for col, index in tbl.bitmap_indexes.items()},
+        "stats":tbl.stats,
+        "distinct":{col:tbl.distinct(col) for col in tbl.columns}
+    }
+    for col in tbl.columns:
+        dtype = tbl.dtypes[col]
+        header["dtypes"][col] = {
+            "type":next(t for t in dtypes if dtypes[t]["cast"] is dtype["cast"]),
+            "size":dtype.get("size")
+        }
+        column = tbl.store[col]
+        if isinstance(column, VarcharColumn):
+            header["pages"][col] = {
+                "codes":add_page(column.codes),
+                "dictionary":add_page(json.dumps(column.dictionary).encode())
+            }
+        elif isinstance(column, KeyColumn):
+            header["pages"][col] = {"keys":add_page(json.dumps(column.data).encode())}
+        else:
+            header["pages"][col] = {"data":add_page(column.data)}
+
+    # Write to a temporary file first so that a table still mapped
+    # from the old file keeps reading consistent pages
+    head = json.dumps(header).encode()
+    head += b" " * (-(len(TABLE_FILE_MAGIC) + 8 + len(head)) % 8)
+    with open(path + ".tmp", "wb") as f:
+        f.write(TABLE_FILE_MAGIC)
+        f.write(len(head).to_bytes(8, "little"))
+        f.write(head)
+        for page in pages:
+            f.write(page)
+            f.write(b"\0" * (-page.nbytes % 8))
+        # The pages are on disk before the name points at them
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+    return 0
+
+def open_table(tokens):
+    """
+    Function to open a table saved with "save table", e.g. "open table df1 'df1.tbl'"
+
+    The file is memory-mapped copy-on-write and the columns are views of their
+    pages, so opening takes the same time for any table size and pages are read
+    from disk as queries touch them. The varchar dictionaries, the column indexes
+    and any sorted or bitmap indexes are built on first use.
+
+    Params:
+        tokens: the tokenized command, without the leading "open table"
+    """
+    name, path = table_file(tokens)
+    try:
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_COPY)
+    except (OSError, ValueError):
+        print(f"ERROR: cannot open table file {path}")
+        return 1
+    if mm[:len(TABLE_FILE_MAGIC)] != TABLE_FILE_MAGIC:
+        print(f"ERROR: {path} is not a saved table file")
+        return 1
+    start = len(TABLE_FILE_MAGIC) + 8
+    length = int.from_bytes(mm[len(TABLE_FILE_MAGIC):start], "little")
+    header = json.loads(mm[start:start+length])
+    name = name or header["name"]
+    view = memoryview(mm)[start+length:]
+    def page(bounds):
+        return view[bounds[0]:bounds[0]+bounds[1]]
+
+    col_dtypes = {}
+    for col, dtype in header["dtypes"].items():
+        col_dtypes[col] = dtypes[dtype["type"]].copy()
+        if dtype["size"] is not None:
+            col_dtypes[col]["size"] = dtype["size"]
+    tbl = Table(name, col_dtypes, header["key"], {})
+    tbl.f_keys = header["f_keys"]
+    tbl.child_keys = header["child_keys"]
+    tbl.nrow = header["nrow"]
+    tbl.stats = header["stats"]
+    tbl.saved_distinct = header["distinct"]
+    for col in tbl.columns:
+        pages = header["pages"][col]
+        if "codes" in pages:
+            tbl.store[col] = VarcharColumn(page(pages["codes"]).cast("i"), page(pages["dictionary"]))
+        elif "keys" in pages:
+            tbl.store[col] = KeyColumn(page(pages["keys"]))
+        else:
+            tbl.store[col] = Column(col_dtypes[col]["typecode"], page(pages["data"]).cast(col_dtypes[col]["typecode"]))
+
+    # Attributes built on first use, see Table.__getattr__
+    del tbl.live, tbl.table, tbl.indexes, tbl.bitmap_indexes
+    def build(kind, defs):
+        def load():
+            indexes = {col:kind(index_name, col) for col, index_name in defs.items()}
+            for index in indexes.values():
+                index.build(tbl)
+            return indexes
+        return load
+    tbl.pending = {
+        "live":lambda: bytearray(page(header["pages"]["live"])),
+        "table":tbl.build_column_indexes,
+        "indexes":build(SortedIndex, header["indexes"]),
+        "bitmap_indexes":build(BitmapIndex, header["bitmap_indexes"])
+    }
+    TABLES[name] = tbl
+    invalidate_plans()
+    return 0
+
+class WriteAheadLog:
+    """
+    Durability for a database directory: a snapshot of every table saved with
+    save_table, plus an append-only log of the commands run since. Logged
+    commands are buffered and written with one fsync per group, and once the
+    log passes WAL_CHECKPOINT_BYTES a checkpoint saves a new snapshot and starts
+    a new log. Snapshot and log files carry a generation number, and
+    manifest.json names the current generation, so a crash at any point
+    recovers one consistent snapshot and the log written after it.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.generation = 0
+        self.group = []
+        self.file = None
+        self.size = 0
+        self.replaying = False
+
+    def path(self, name, generation = None):
+        generation = self.generation if generation is None else generation
+        return os.path.join(self.directory, f"{name}.{generation}")
+
+    def recover(self):
+        """
+        Opens the tables of the last snapshot and replays the log on top of them
+        """
+        manifest = os.path.join(self.directory, "manifest.json")
+        tables = []
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                saved = json.load(f)
+            self.generation = saved["generation"]
+            tables = saved["tables"]
+        for name in tables:
+            open_table([name, self.path(name) + ".tbl"])
+
+        commands = []
+        self.size = 0
+        if os.path.exists(self.path("wal") + ".log"):
+            with open(self.path("wal") + ".log", "rb") as f:
+                for line in f:
+                    # A torn final record was never acknowledged
+                    try:
+                        commands.append(json.loads(line))
+                    except ValueError:
+                        break
+                    self.size += len(line)
+        self.replaying = True
+        statements = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            for cmd in commands:
+                if isinstance(cmd, str):
+                    process_input([cmd])
+                    continue
+                # An executed prepared statement, resolved once per statement text
+                if cmd["statement"] not in statements:
+                    statements[cmd["statement"]] = new_statement("replayed", cmd["statement"])
+                if statements[cmd["statement"]] is not None:
+                    run_statement(statements[cmd["statement"]], cmd["values"])
+        self.replaying = False
+
+        # Cut off any torn record before appending new ones
+        self.file = open(self.path("wal") + ".log", "ab")
+        self.file.truncate(self.size)
+        return len(commands)
+
+    def log(self, cmd):
+        """
+        Adds a command to the current group, writing the group once it is full.
+        A command is the text of a statement, or for an executed prepared
+        statement a dictionary of its text and values.
+        """
+        if self.replaying:
+            return
+        self.group.append(cmd)
+        if len(self.group) >= WAL_GROUP_RECORDS:
+            self.commit()
+
+    def commit(self):
+        """
+        Writes the current group of commands with a single fsync
+        """
+        if not self.group:
+            return
+        data = "".join(json.dumps(cmd) + "\n" for cmd in self.group).encode()
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.size += len(data)
+        self.group = []
+        if self.size >= WAL_CHECKPOINT_BYTES:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Saves every table as the next generation's snapshot, switches to
+        it in the manifest, and starts an empty log
+        """
+        self.commit()
+        old = self.generation
+        self.generation += 1
+        for name in TABLES:
+            save_table([name, self.path(name) + ".tbl"])
+        # The snapshot files are on disk before the manifest names them
+        self.sync_directory()
+        manifest = os.path.join(self.directory, "manifest.json")
+        with open(manifest + ".tmp", "w") as f:
+            json.dump({"generation":self.generation, "tables":list(TABLES)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(manifest + ".tmp", manifest)
+
+        self.file.close()
+        self.file = open(self.path("wal") + ".log", "ab")
+        self.size = 0
+        # The renames and the new log are on disk before the old generation is removed
+        self.sync_directory()
+        for file in os.listdir(self.directory):
+            if file.endswith(f".{old}.tbl") or file == f"wal.{old}.log":
+                os.remove(os.path.join(self.directory, file))
+
+    def sync_directory(self):
+        """
+        Fsyncs the database directory, making renames and new files in it durable
+        """
+        if not hasattr(os, "O_DIRECTORY"):
+            return
+        fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def open_database(tokens):
+    """
+    Function to make a directory the durable home of the tables, e.g.
+    "open database 'db'". The last snapshot in the directory is opened and its
+    log replayed, and from then on every command that changes a table is logged.
+
+    Params:
+        tokens: the tokenized command, without the leading "open database"
+    """
+    global WAL
+    if len(tokens) != 1:
+        print("ERROR: open database query not properly formatted")
+        return 1
+    # Tables that are open when the first database is opened are adopted
+    # by it, while switching databases closes the tables of the last one
+    if WAL is not None:
+        WAL.checkpoint()
+        WAL.file.close()
+        TABLES.clear()
+        invalidate_plans()
+    directory = tokens[0].strip("'")
+    os.makedirs(directory, exist_ok = True)
+    WAL = WriteAheadLog(directory)
+    replayed = WAL.recover()
+    print(f"Opened database {directory} with {len(TABLES)} tables, replayed {replayed} logged commands")
+    return 0
+
+# region PREPARED STATEMENTS ##########################################################
+def mark_params(statement):
+    """
+    Replaces each ? placeholder outside quotes with a numbered PARAM_MARKER
+
+    Return:
+        (the marked statement, the number of placeholders)
+    """
+    out = []
+    quote = ""
+    count = 0
+    for ch in statement:
+        if quote:
+            if ch == quote:
+                quote = ""
+        elif ch in "'\"":
+            quote = ch
+        elif ch == "?":
+            out.append(PARAM_MARKER.format(count))
+            count += 1
+            continue
+        out.append(ch)
+    return "".join(out), count
+
+def render_params(text, values, quoted):
+    """
+    Writes bound values into a marked statement as literals, in the form
+    process_input parses: quoted inside the where clause, and bare in insert
+    values and SET, whose parsers keep quotes as part of the value
+
+    Params:
+        text: the statement from mark_params
+        values: dictionary of parameter number -> cast value
+        quoted: the parameter numbers that sit in the where clause
+    """
+    for i, val in values.items():
+        if i in quoted:
+            val = f"'{val}'" if isinstance(val, str) else repr(val)
+        text = text.replace(PARAM_MARKER.format(i), str(val))
+    return text
+
+def markers_in(text):
+    """
+    Returns the parameter numbers of the markers in a piece of a statement
+    """
+    return [int(i) for i in re.findall(r"'\?param(\d+)\?'", text)]
+
+def resolve_params(stmt):
+    """
+    Works out, once per prepared statement, the type cast of each parameter
+    from the column it is compared with, assigned to or inserted into, and
+    which parameters bind straight into the resolved where tree. Those are
+    the ones in comparisons; parameters in IN lists and LIKE patterns are
+    written into the statement text instead. New values in SET are kept by
+    column so execute can hand them to Table.update_where already cast.
+
+    Return:
+        1 if error else 0
+    """
+    text = stmt["text"]
+    tokens = text.split()
+    casts = [None] * stmt["count"]
+    bind = set()
+    quoted = set()
+
+    def column_cast(aliases, ref):
+        alias, _, col = ref.rpartition(".")
+        tbl = aliases.get(alias, list(aliases.values())[0])
+        if tbl not in TABLES or col not in TABLES[tbl].dtypes:
+            return None
+        return TABLES[tbl].dtypes[col]["cast"]
+
+    if stmt["kind"] == "insert":
+        name = tokens[2] if len(tokens) > 2 else ""
+        if name not in TABLES:
+            print("ERROR: the table you are trying to insert into does not exist")
+            return 1
+        # Parsed as process_input parses a plain insert, so literals are
+        # stored the same way with and without parameters
+        columns, rows = parse_insert(tokens)
+        values = rows[0]
+        if len(rows) != 1 or len(columns) != len(values) or any(c not in TABLES[name].dtypes for c in columns):
+            print("ERROR: number of insert columns does not match number of insert values, check insert syntax")
+            return 1
+        # The row holds a parameter number for each ? and the text of each literal
+        stmt["table"] = name
+        stmt["row"] = {}
+        for col, val in zip(columns, values):
+            found = markers_in(val)
+            if found:
+                casts[found[0]] = TABLES[name].dtypes[col]["cast"]
+                stmt["row"][col] = found[0]
+            else:
+                stmt["row"][col] = val
+    else:
+        if stmt["kind"] == "select":
+            col_list, dfs_list, where, join_list = get_df_col_and_where_list(text)
+            aliases = get_df_aliases(dfs_list)
+        else:
+            stmt["table"] = tokens[1] if stmt["kind"] == "update" else tokens[2]
+            if stmt["table"] not in TABLES:
+                print(f"ERROR: table {stmt['table']} does not exist")
+                return 1
+            aliases = {stmt["table"]:stmt["table"]}
+            lowered = [t.lower() for t in tokens]
+            where = [" ".join(tokens[lowered.index("where")+1:])] if "where" in lowered else []
+            if stmt["kind"] == "update":
+                parsed = parse_update(tokens)
+                if parsed is None:
+                    print("ERROR: update query not properly formatted")
+                    return 1
+                # The SET keeps the cast value of each literal, and the parameter
+                # number of each ? apart so literal ints are not read as numbers
+                stmt["set"] = {}
+                stmt["set_params"] = {}
+                for col, val in parsed[1]:
+                    cast = column_cast(aliases, col)
+                    if cast is None or col == TABLES[stmt["table"]].key:
+                        print(f"ERROR: cannot set column {col} of table {stmt['table']}")
+                        return 1
+                    found = markers_in(val)
+                    if found:
+                        casts[found[0]] = cast
+                        stmt["set_params"][col] = found[0]
+                        continue
+                    try:
+                        stmt["set"][col] = cast(val)
+                    except ValueError:
+                        print(f"ERROR: cannot convert value of type {type(val)} to {cast}")
+                        return 1
+
+        if where:
+            for leaf in where_leaves(parse_where(where[0])):
+                found = markers_in(leaf)
+                if not found:
+                    continue
+                ref = re.search(r"[A-Za-z_]\w*(\.\w+)?", re.sub(r"'\?param\d+\?'", "", leaf))
+                cast = column_cast(aliases, ref.group(0)) if ref else None
+                for i in found:
+                    casts[i] = cast
+                    quoted.add(i)
+                    if not re.search(r"\s(not\s+)?(in|like)\s", leaf, re.I):
+                        bind.add(i)
+
+    if any(cast is None for cast in casts):
+        print("ERROR: cannot tell which column a ? parameter refers to")
+        return 1
+    stmt["casts"] = casts
+    stmt["bind"] = bind
+    stmt["quoted"] = quoted
+    return 0
+
+def prepare(name, statement):
+    """
+    Function to prepare a select, insert, update or delete with ? placeholders,
+    e.g. prepare("by_year", "select b.name from df2 as b where b.year == ?").
+    The statement is checked and its parameter types worked out once, and a
+    select's where clause is parsed once through the plan cache.
+
+    Params:
+        name: the name to execute the statement by
+        statement: the statement text
+
+    Return:
+        1 if error else 0
+    """
+    stmt = new_statement(name, statement)
+    if stmt is None:
+        return 1
+    PREPARED[name] = stmt
+    return 0
+
+def new_statement(name, statement):
+    """
+    Builds and resolves a prepared statement without registering it
+
+    Return:
+        the statement dictionary, or None if error
+    """
+    text, count = mark_params(statement)
+    kind = text.split()[0].lower() if text.split() else ""
+    if kind not in ["select","insert","update","delete"]:
+        print("ERROR: only select, insert, update and delete statements can be prepared")
+        return None
+    stmt = {"name":name, "statement":statement, "text":text, "kind":kind, "count":count, "casts":None}
+    if resolve_params(stmt) == 1:
+        return None
+    return stmt
+
+def execute(name, values, do_print = True, commit = True):
+    """
+    Function to run a prepared statement, e.g. execute("by_year", [1990]).
+    Each value is cast once to the type of its column, then an insert goes
+    straight to Table.insert, and a select, update or delete runs its cached
+    where tree with the values bound in.
+
+    Params:
+        name: the name given to prepare
+        values: one value per ? placeholder, in order
+        commit: whether a logged change is committed before returning; False
+            when process_input commits the whole batch of commands itself
+
+    Return:
+        the select output, or 1 if error else 0
+    """
+    if name not in PREPARED:
+        print(f"ERROR: no prepared statement named {name}")
+        return 1
+    return run_statement(PREPARED[name], values, do_print, commit)
+
+def run_statement(stmt, values, do_print = True, commit = True):
+    """
+    Function to run a prepared statement dictionary with its values, for
+    execute and for replaying the write-ahead log
+
+    Return:
+        the select output, or 1 if error else 0
+    """
+    name = stmt["name"]
+    if stmt["casts"] is None and resolve_params(stmt) == 1:
+        return 1
+    if len(values) != stmt["count"]:
+        print(f"ERROR: statement {name} takes {stmt['count']} parameters but {len(values)} were given")
+        return 1
+    try:
+        values = [cast(val) for cast, val in zip(stmt["casts"], values)]
+    except ValueError:
+        print(f"ERROR: cannot convert parameters {values} to types {stmt['casts']}")
+        return 1
+
+    # Changes go to the write-ahead log as the statement and its cast
+    # values, which replay through run_statement with nothing re-parsed
+    if stmt["kind"] != "select" and WAL is not None:
+        WAL.log({"statement":stmt["statement"], "values":values})
+
+    if stmt["kind"] == "insert":
+        row = {col:values[val] if isinstance(val, int) else val for col, val in stmt["row"].items()}
+        result = TABLES[stmt["table"]].insert(row)
+    else:
+        bound = {i:values[i] for i in stmt["bind"]}
+        text = render_params(stmt["text"], {i:val for i, val in enumerate(values) if i not in stmt["bind"]}, stmt["quoted"])
+        if stmt["kind"] == "select":
+            return process_select(text, do_print, params = bound)
+        if stmt["kind"] == "update":
+            _, _, where = parse_update(text.split())
+            new = dict(stmt["set"])
+            new.update({col:values[i] for col, i in stmt["set_params"].items()})
+            result = TABLES[stmt["table"]].update_where(new, where, params = bound)
+        else:
+            result = TABLES[stmt["table"]].delete(text.split()[2:], params = bound)
+
+    # A change is durable once execute returns
+    if commit and WAL is not None and not WAL.replaying:
+        WAL.commit()
+    return result
+
+def parse_execute(tokens):
+    """
+    Function to split an "execute name (v1, v2)" command into the name and values
+    """
+    name = tokens[0] if tokens else ""
+    values = " ".join(tokens[1:]).strip()
+    if values.startswith("(") and values.endswith(")"):
+        values = values[1:-1]
+    values = [v.strip().strip("'\"") for v in values.split(",")] if values.strip() else []
+    return name, values
+# endregion PREPARED STATEMENTS #######################################################
+
+def parse_insert(tokens):
+    """
+    Function to split the tokens of an "insert into t (cols) values (...), (...)"
+    command. Whitespace and parentheses are dropped and values are not unquoted,
+    so the value texts are exactly what Table.insert casts.
+
+    Return:
+        (list of columns, list of value texts for each row)
+    """
+    c_v = [[],[]]
+    flip = 0
+    for i in range(3,len(tokens)):
+        if "values" in tokens[i].lower():
+            flip = 1
+        else:
+            c_v[flip].append(tokens[i])
+    c_v = ["".join(part) for part in c_v]
+    columns = [e for e in c_v[0].replace("(","").replace(")","").split(",") if e]
+    # VALUES (...), (...) gives one list of values per row
+    rows = [[e for e in row.replace("(","").replace(")","").split(",") if e]
+            for row in re.split(r"\)\s*,\s*\(", c_v[1])]
+    return columns, rows
+
+def parse_update(tokens):
+    """
+    Function to split the tokens of an "update t set col = val, ... where ..."
+    command. SET values are not unquoted, like insert values.
+
+    Return:
+        (table, list of (column, value text), where clause text), or None if
+        a SET assignment has no "="
+    """
+    cmd_sects = {
+        "df":"",
+        "set":"",
+        "where":""
+    }
+    key = ""
+    for t in tokens:
+        if t.lower() == "update":
+            key = "df"
+        elif t.lower() == "set":
+            key = "set"
+        elif t.lower() == "where":
+            key = "where"
+        else:
+            cmd_sects[key] += t + " "
+    assigns = cmd_sects["set"].split(",")
+    if any("=" not in c for c in assigns):
+        return None
+    sets = [(c.split("=")[0].strip(), c.split("=")[1].strip()) for c in assigns]
+    return cmd_sects["df"].strip(), sets, cmd_sects["where"].strip()
+
+def set_option(tokens):
+    """
+    Function to change one of the engine SETTINGS, e.g. "set vectorized off"
+
+    Params:
+        tokens: the tokenized command, without the leading "set"
+    """
+    if len(tokens) != 2 or tokens[0].lower() not in SETTINGS:
+        print(f"ERROR: unknown setting, available settings are {', '.join(SETTINGS)}")
+        return 1
+    name = tokens[0].lower()
+    value = tokens[1].lower()
+    if isinstance(SETTINGS[name], bool):
+        if value not in ["on","off","true","false"]:
+            print(f"ERROR: setting {name} must be on or off")
+            return 1
+        value = value in ["on","true"]
+        if name == "vectorized" and value and np is None:
+            print("ERROR: vectorized mode requires numpy")
+            return 1
+    else:
+        try:
+            value = type(SETTINGS[name])(value)
+        except ValueError:
+            print(f"ERROR: cannot convert {value} to type {type(SETTINGS[name])}")
+            return 1
+    SETTINGS[name] = value
+    return 0
+
 def process_input(cmd_list):
     def first_x(tokens, x):
         return [t.lower() for t in tokens[:x]]
@@ -374,15 +2281,31 @@ def process_input(cmd_list):
     for cmd in cmd_list:
         start_time = time.time()
         tokens = cmd.split()
-        if first_x(tokens, 2) == ["create","table"]:
+        # Commands that change a table are written to the write-ahead log
+        logged = WAL is not None and (first_x(tokens, 1) in [["insert"], ["update"], ["delete"], ["drop"], ["analyze"]]\
+            or first_x(tokens, 2) in [["create","table"], ["create","index"], ["create","bitmap"], ["open","table"]])
+        if first_x(tokens, 1) == ["execute"]:
+            execute(*parse_execute(tokens[1:]), commit = False)
+        elif first_x(tokens, 1) == ["prepare"]:
+            if len(tokens) < 4 or tokens[2].lower() != "as":
+                print("ERROR: prepare query not properly formatted, use prepare <name> as <statement>")
+            else:
+                prepare(tokens[1], " ".join(tokens[3:]))
+        elif first_x(tokens, 2) == ["create","index"]:
+            create_index(tokens[2:])
+        elif first_x(tokens, 3) == ["create","bitmap","index"]:
+            create_index(tokens[3:], bitmap = True)
+        elif first_x(tokens, 2) == ["create","table"]:
             name, tbl = create_table(tokens[2:])
             if name:
                 TABLES[name] = tbl
+                invalidate_plans()
         elif first_x(tokens, 2) == ["drop","table"]:
             name = tokens[2]
             if name in TABLES:
                 TABLES[name].empty()
                 TABLES.pop(name)
+                invalidate_plans()
             else:
                 print("ERROR: the table you are trying to load into does not exist")
             
@@ -393,6 +2316,10 @@ def process_input(cmd_list):
                     break
             if name in TABLES:
                 TABLES[name].import_file(tokens[2:])
+                # Bulk loads are made durable by a checkpoint
+                # rather than by logging every row
+                if WAL is not None and not WAL.replaying:
+                    WAL.checkpoint()
             else:
                 print("ERROR: the table you are trying to load into does not exist")
         elif first_x(tokens, 2) == ["insert","into"]:
@@ -400,21 +2327,19 @@ def process_input(cmd_list):
             if name not in TABLES:
                 print("ERROR: the table you are trying to insert into does not exist")
             else:
-                c_v = ["",""]
-                flip = 0
-                for i in range(3,len(tokens)):
-                    if "values" in tokens[i].lower():
-                        flip = 1
-                    else:
-                        c_v[flip] += tokens[i]
-                columns = [e for e in c_v[0].replace("(","").replace(")","").split(",") if e]
-                vals = [e for e in c_v[1].replace("(","").replace(")","").split(",") if e]
-                if len(columns) != len(vals):
+                columns, rows = parse_insert(tokens)
+                if any(len(columns) != len(vals) for vals in rows):
                     print("ERROR: number of insert columns does not match number of insert values, check insert syntax")
+                elif len(rows) == 1:
+                    TABLES[name].insert({c:v for c,v in zip(columns, rows[0])})
                 else:
-                    TABLES[name].insert({c:v for c,v in zip(columns, vals)})
+                    TABLES[name].insert_rows(columns, rows)
         elif first_x(tokens, 1) == ["select"]:
             process_select(cmd)
+        elif first_x(tokens, 2) == ["explain","select"]:
+            process_select(" ".join(tokens[1:]), explain = True)
+        elif first_x(tokens, 1) == ["analyze"]:
+            analyze_table(tokens[1:])
         elif first_x(tokens, 1) == ["update"]:
             name = tokens[1]
             if name not in TABLES:
@@ -424,6 +2349,23 @@ def process_input(cmd_list):
                 print("ERROR: update query not properly formatted")
             else:
                 TABLES[name].update(tokens)
+        elif first_x(tokens, 2) == ["save","table"]:
+            save_table(tokens[2:])
+        elif first_x(tokens, 2) == ["open","table"]:
+            open_table(tokens[2:])
+        elif first_x(tokens, 2) == ["open","database"]:
+            open_database(tokens[2:])
+        elif first_x(tokens, 1) == ["checkpoint"]:
+            if WAL is None:
+                print("ERROR: no database is open")
+            else:
+                WAL.checkpoint()
+        elif first_x(tokens, 1) == ["set"]:
+            set_option(tokens[1:])
+        elif first_x(tokens, 2) == ["show","memory"]:
+            memory_report()
+        elif first_x(tokens, 2) == ["show","cache"]:
+            cache_report()
         elif first_x(tokens, 2) == ["delete","from"]:
             name = tokens[2]
             if name not in TABLES:
@@ -434,214 +2376,759 @@ def process_input(cmd_list):
             else:
                 TABLES[name].delete(tokens[2:])
 
+        if logged:
+            WAL.log(cmd)
+
+        print("Time for", cmd, ": %s nanoseconds" % round(1000000000*(time.time() - start_time)))     
+
+    # Group commit: one fsync for the commands logged by this call
+    if WAL is not None and not WAL.replaying:
+        WAL.commit()
+
+# region SELECT ########################################################################
+def process_select(cmd, do_print = True, explain = False, params = None, cursor = False):
+
+    # parse and validate the query, or reuse the result for the same text,
+    # then bind the values of any prepared statement parameters into it
+    query = resolve_select(cmd)
+    if query == 1:
+        return 1
+    if params:
+        query = bind_query(query, params)
+    col_funcs = query["col_funcs"]
+    which_columns = query["which_columns"]
+    dfs_list = query["dfs_list"]
+    dfs = query["dfs"]
+    logic = query["logic"]
+    conjunctive = query["conjunctive"]
+    trees = query["trees"]
+    join_cols = query["join_cols"]
+    order = query["order"]
+    limit = query["limit"]
+
+    # A select already run on the same versions of its tables is served from RESULT_CACHE
+    cache_key = None
+    if not explain and SETTINGS["result_cache_bytes"] > 0:
+        cache_key = (" ".join(cmd.split()), tuple(sorted(params.items())) if params else ())
+        versions = tuple(TABLES[df].version for df in dfs)
+        entry = RESULT_CACHE.get(cache_key)
+        if entry is not None and entry["versions"] == versions:
+            RESULT_CACHE.move_to_end(cache_key)
+            RESULT_STATS["hits"] += 1
+            if "output" in entry:
+                return output_result({label:list(values) for label, values in entry["output"].items()}, do_print, cursor)
+            return select_output(query, entry["keys"], do_print, cursor)
+        RESULT_STATS["misses"] += 1
+
+    # Plan the conditions and the join before any rows are materialized
+    plan = plan_select(dfs, trees, join_cols)
+    if explain:
+        print_plan(plan)
+        return plan
+
+    outDict = {}
+    for df in dfs:
+        outDict[df] = {
+            "logic":logic,
+            "columns to get":{},
+            "subset lists":[],
+            "subsetted":False
+        }
+        if df in which_columns:
+            outDict[df]["columns to get"] = which_columns[df]
+
+        subset = filter_table(df, plan["tables"][df])
+        if subset is not None:
+            outDict[df]["subset lists"] = subset
+            outDict[df]["subsetted"] = True
+
+    # Aggregates over a whole table are read from its indexes when possible
+    if query["aggregate"] is not None and len(dfs_list) == 1 and not outDict[dfs[0]]["subsetted"]:
+        final_output = index_aggregate(query["aggregate"], dfs[0])
+        if final_output is not None:
+            final_output = order_output(final_output, order, limit)
+            if cache_key is not None:
+                cache_result(cache_key, {"versions":versions, "output":final_output})
+            return output_result(final_output, do_print, cursor)
+
+    #code to join tables (if necessary)
+    if len(dfs_list) > 1:
+        if outDict[dfs[0]]["subsetted"] is True:
+            temp1 = outDict[dfs[0]]["subset lists"]
+        else:
+            temp1 = TABLES[dfs[0]].row_ids()
+        if outDict[dfs[1]]["subsetted"] is True:
+            temp2 = outDict[dfs[1]]["subset lists"]
+        else:
+            temp2 = TABLES[dfs[1]].row_ids()
+        final_keys = which_join(dfs[0], dfs[1], temp1, temp2, join_cols[dfs[0]], join_cols[dfs[1]], conjunctive, plan["join"])
+    else:
+        if outDict[dfs[0]]["subsetted"] is True:
+            final_keys = {dfs[0]:outDict[dfs[0]]["subset lists"]}
+        else:
+            rids = None
+            if query["aggregate"] is None and (order is not None or limit is not None):
+                # read the rows in index order, or stop at the limit
+                rids = whole_table_rows(dfs[0], order, limit)
+            if rids is not None:
+                final_keys = {dfs[0]:rids}
+                order = limit = None
+            elif (do_print or cursor) and query["aggregate"] is None:
+                # a streamed result reads the live rows as they are fetched
+                live = TABLES[dfs[0]].live
+                final_keys = {dfs[0]:itertools.compress(range(len(live)), live)}
+            else:
+                final_keys = {dfs[0]:TABLES[dfs[0]].row_ids()}
+            
+    #FINAL OUTPUT!
+    if query["aggregate"] is not None:
+        # Grouped and global aggregates, over the filtered and joined rows
+        whole = len(dfs) == 1 and not outDict[dfs[0]]["subsetted"]
+        final_output = aggregate(query["aggregate"], final_keys, whole)
+        final_output = order_output(final_output, order, limit)
+        if cache_key is not None:
+            cache_result(cache_key, {"versions":versions, "output":final_output})
+        return output_result(final_output, do_print, cursor)
+
+    final_keys = order_rows(final_keys, order, limit)
+    if cache_key is not None and all(isinstance(rids, list) for rids in final_keys.values()):
+        # the row ids are cached, and the output is projected from them again on a hit
+        final_keys = {df:array("q", rids) for df, rids in final_keys.items()}
+        cache_result(cache_key, {"versions":versions, "keys":final_keys})
+    return select_output(query, final_keys, do_print, cursor)
+
+def select_output(query, final_keys, do_print, cursor):
+    """
+    Projects the output columns of a select that is not an aggregation
+
+    Params:
+        query: the resolved select from resolve_select
+        final_keys: dictionary of table -> row ids, aligned across tables for a join
+
+    Return:
+        Cursor over the rows if do_print or cursor, else dictionary of column -> list of values
+    """
+    # output columns by name, a name in both tables shows the later table's column
+    columns = {}
+    for df in query["dfs"]:
+        for column in query["which_columns"].get(df, {}):
+            columns[column] = (df, column)
+    if do_print or cursor:
+        result = Cursor(list(columns), project_rows(list(columns.values()), final_keys))
+        if do_print:
+            print_cursor(result)
+        return result
+    return {label:list(TABLES[df].store[col].take(final_keys[df])) for label, (df, col) in columns.items()}
+
+def where_rows(df, where, params = None):
+    """
+    Returns the row ids of a table that satisfy a where clause, running the
+    planned where tree without projecting any columns
+
+    Params:
+        df: the table name
+        where: the text of the where clause
+        params: values bound to parameter markers in the where clause
+    """
+    query = resolve_select(f"select * from {df} where {where}")
+    if query == 1:
+        return []
+    if params:
+        query = bind_query(query, params)
+    plan = plan_select(query["dfs"], query["trees"], query["join_cols"])
+    rids = filter_table(df, plan["tables"][df])
+    return TABLES[df].row_ids() if rids is None else rids
+
+def resolve_select(cmd):
+    """
+    Parses and validates a select: its output columns and aggregates, table
+    aliases, join columns and where tree with compiled predicates. Results
+    are kept in PLAN_CACHE, an LRU keyed on the query text with whitespace
+    normalized, so a repeated query skips all of this. The where tree is
+    re-planned by plan_select on every run, since access paths and join
+    order depend on the current rows and indexes.
+
+    Return:
+        the resolved query dictionary, or 1 on error
+    """
+    key = " ".join(cmd.split())
+    if key in PLAN_CACHE:
+        PLAN_CACHE.move_to_end(key)
+        return PLAN_CACHE[key]
+
+    # get columns, dfs, where condition, group by columns, ordering and limit
+    cmd, order, limit = get_order_limit(cmd)
+    cmd, group_list = get_group_by(cmd)
+    col_list, dfs_list, where, join_list = get_df_col_and_where_list(cmd)
+
+    # get df alias names
+    df_aliases = get_df_aliases(dfs_list)
+    if df_aliases == 1:
+        return 1
+
+    aggregate = None
+    if group_list or any("(" in col for col in col_list):
+        # resolve the group by columns and the aggregates to compute
+        aggregate = get_aggregates(col_list, group_list, df_aliases)
+        if aggregate == 1:
+            return 1
+        col_funcs = {}
+        which_columns = {}
+    else:
+        # get the aliases of the columns to be gotten
+        col_funcs = get_col_funcs(col_list)
+
+        # create column dict that connects aliases
+        which_columns = get_which_columns(col_funcs, df_aliases, dfs_list)
+        if which_columns == 1:
+            return 1
+
+    if order is not None:
+        order = resolve_order(order, df_aliases, aggregate)
+        if order == 1:
+            return 1
+
+    logic = ""
+    trees = {}
+    if len(where)>0:
+        # Parse the where clause into an and/or/not tree, then build the
+        # predicates for its leaf conditions and split the tree by table
+        where_tree = parse_where(where[0])
+        condition_dict = get_cond_dict(where_leaves(where_tree), df_aliases)
+        if condition_dict == 1:
+            return 1
+        logic = where_tree["op"] if where_tree["op"] in ["and","or"] else ""
+        predicates = get_predicates(condition_dict, df_aliases)
+        if predicates == 1:
+            return 1
+        trees = split_where_tree(where_tree, {pred["cond"]:pred for pred in predicates})
+        if trees == 1:
+            return 1
+    dfs = []
+    for x in dfs_list:
+        dfs.append(x.split()[0])
+    conjunctive = True
+    if logic == "or" or logic == "OR":
+        conjunctive = False
+    elif logic == "and" or logic == "AND":
+        conjunctive = True
+
+    join_cols = get_join_cols(join_list, df_aliases)
+    if len(dfs) > 1 and any(df not in join_cols for df in dfs[:2]):
+        print("ERROR: joining tables requires a join condition on both tables")
+        return 1
+
+    query = {
+        "col_funcs":col_funcs,
+        "which_columns":which_columns,
+        "dfs_list":dfs_list,
+        "dfs":dfs,
+        "logic":logic,
+        "conjunctive":conjunctive,
+        "trees":trees,
+        "join_cols":join_cols,
+        "aggregate":aggregate,
+        "order":order,
+        "limit":limit
+    }
+    PLAN_CACHE[key] = query
+    if len(PLAN_CACHE) > PLAN_CACHE_SIZE:
+        PLAN_CACHE.popitem(last = False)
+    return query
+
+def bind_query(query, params):
+    """
+    Returns a copy of a resolved query whose where trees have each parameter
+    marker replaced by its bound value. Only the predicates that hold a
+    marker are copied, and the rest of the query is shared.
+
+    Params:
+        query: the resolved query from resolve_select
+        params: dictionary of parameter number -> cast value
+    """
+    def bind_node(node):
+        node = dict(node)
+        if node["op"] != "pred":
+            node["children"] = [bind_node(child) for child in node["children"]]
+        elif "'?param" in node["pred"].get("expr", ""):
+            pred = dict(node["pred"])
+            for i, val in params.items():
+                pred["expr"] = pred["expr"].replace(PARAM_MARKER.format(i), repr(val))
+                pred["cond"] = pred["cond"].replace(PARAM_MARKER.format(i), repr(val))
+            node["pred"] = pred
+        return node
+
+    bound = dict(query)
+    bound["trees"] = {df:bind_node(tree) for df, tree in query["trees"].items()}
+    return bound
+
+def invalidate_plans():
+    """
+    Empties PLAN_CACHE and RESULT_CACHE, for when the set of tables or their
+    columns change, and makes the prepared statements look up their
+    parameter types again
+    """
+    PLAN_CACHE.clear()
+    RESULT_CACHE.clear()
+    RESULT_STATS["bytes"] = 0
+    for stmt in PREPARED.values():
+        stmt["casts"] = None
+
+def cache_result(key, entry):
+    """
+    Adds a select result to RESULT_CACHE, evicting the least recently used
+    results until the cache fits in SETTINGS["result_cache_bytes"]
+
+    Params:
+        key: the normalized query text and parameter values
+        entry: dictionary with the table "versions" and either the row id
+            arrays ("keys") or the aggregated "output"
+    """
+    if "keys" in entry:
+        size = sum(rids.itemsize * len(rids) for rids in entry["keys"].values())
+    else:
+        size = sum(sys.getsizeof(value) for values in entry["output"].values() for value in values)
+    entry["bytes"] = size + len(key[0])
+    old = RESULT_CACHE.pop(key, None)
+    if old is not None:
+        RESULT_STATS["bytes"] -= old["bytes"]
+    if entry["bytes"] > SETTINGS["result_cache_bytes"]:
+        return
+    RESULT_CACHE[key] = entry
+    RESULT_STATS["bytes"] += entry["bytes"]
+    while RESULT_STATS["bytes"] > SETTINGS["result_cache_bytes"]:
+        _, old = RESULT_CACHE.popitem(last = False)
+        RESULT_STATS["bytes"] -= old["bytes"]
+
+def cache_report():
+    """
+    Function to print the hits, misses and size of the result cache
+    """
+    table = PrettyTable()
+    table.field_names = ["results", "bytes", "budget", "hits", "misses", "hit rate"]
+    lookups = RESULT_STATS["hits"] + RESULT_STATS["misses"]
+    rate = RESULT_STATS["hits"] / lookups if lookups else 0
+    table.add_row([len(RESULT_CACHE), RESULT_STATS["bytes"], SETTINGS["result_cache_bytes"],
+                   RESULT_STATS["hits"], RESULT_STATS["misses"], f"{rate:.1%}"])
+    print(table)
+
+class Cursor:
+    """
+    Lazy result of a select. Rows are projected from their row ids a batch
+    at a time as they are fetched, so a large result is never held in full.
+    """
+
+    def __init__(self, labels, batches):
+        """
+        Params:
+            labels: the output column names
+            batches: iterator of lists of row tuples
+        """
+        self.labels = labels
+        self.batches = batches
+        self.rows = []
+        self.pos = 0
+
+    def fill(self):
+        # Moves to the next batch once the current one is used up
+        while self.pos >= len(self.rows):
+            rows = next(self.batches, None)
+            if rows is None:
+                return False
+            self.rows = rows
+            self.pos = 0
+        return True
+
+    def fetchone(self):
+        """
+        Returns the next row as a tuple, or None when there are no more
+        """
+        if not self.fill():
+            return None
+        self.pos += 1
+        return self.rows[self.pos - 1]
+
+    def fetchmany(self, size = None):
+        """
+        Returns a list of up to size rows, empty when there are no more
+
+        Params:
+            size: number of rows, CURSOR_BATCH_ROWS by default
+        """
+        size = size or CURSOR_BATCH_ROWS
+        rows = []
+        while len(rows) < size and self.fill():
+            taken = self.rows[self.pos:self.pos + size - len(rows)]
+            rows.extend(taken)
+            self.pos += len(taken)
+        return rows
+
+    def fetchall(self):
+        rows = []
+        while self.fill():
+            rows.extend(self.rows[self.pos:])
+            self.pos = len(self.rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+def project_rows(columns, final_keys):
+    """
+    Generator that projects the output columns of a select, one batch of
+    CURSOR_BATCH_ROWS row ids at a time
+
+    Params:
+        columns: list of (table, column) to output
+        final_keys: dictionary of table -> row ids (a list or an iterator),
+            aligned across tables for a join
+
+    Yields:
+        list of row tuples
+    """
+    rids = {df:iter(keys) for df, keys in final_keys.items()}
+    while True:
+        batch = {df:list(itertools.islice(keys, CURSOR_BATCH_ROWS)) for df, keys in rids.items()}
+        if not next(iter(batch.values())):
+            return
+        yield list(zip(*[TABLES[df].store[col].take(batch[df]) for df, col in columns]))
+
+def output_result(final_output, do_print, cursor):
+    # Prints an already computed output, or hands it out through a Cursor
+    if not (do_print or cursor):
+        return final_output
+    result = Cursor(list(final_output), iter([list(zip(*final_output.values()))]))
+    if do_print:
+        print_cursor(result)
+    return result
+
+def print_cursor(result):
+    """
+    Takes the final output and prints it for the user (last step!). Each batch
+    is printed as soon as it is fetched, keeping the column widths of the
+    batches before it, so the first rows show before the rest are read. A
+    batch with wider values closes the rows above and repeats the header at
+    the new widths, so no row runs past its border.
+    """
+    widths = {}
+    bottom = None
+    for rows in iter(result.fetchmany, []):
+        table = PrettyTable()
+        table.field_names = result.labels
+        table.min_width = widths
+        table.add_rows(rows)
+        lines = table.get_string().splitlines()
+        # the top border holds the width of every column
+        grown = {label:len(dashes) - 2 for label, dashes in zip(result.labels, lines[0].split("+")[1:-1])}
+        if bottom is None:
+            print("\n".join(lines[:-1]), flush = True)
+        elif grown != widths:
+            print("\n".join([bottom] + lines[:-1]), flush = True)
+        else:
+            print("\n".join(lines[3:-1]), flush = True)
+        widths = grown
+        bottom = lines[-1]
+    if bottom is None:
+        table = PrettyTable()
+        table.field_names = result.labels
+        print(table)
+    else:
+        print(bottom)
+
+def get_order_limit(cmd):
+    # Splits a trailing "order by col [asc|desc]" and "limit n [offset m]" off the query
+    limit = None
+    match = re.search(r"\s+limit\s+(\d+)(?:\s+offset\s+(\d+))?\s*$", cmd, re.I)
+    if match is not None:
+        limit = (int(match.group(2) or 0), int(match.group(1)))
+        cmd = cmd[:match.start()]
+    order = None
+    match = re.search(r"\s+order\s+by\s+(.+?)(?:\s+(asc|desc))?\s*$", cmd, re.I)
+    if match is not None:
+        order = {"ref":match.group(1).strip(), "desc":(match.group(2) or "").lower() == "desc"}
+        cmd = cmd[:match.start()]
+    return cmd, order, limit
+
+def resolve_column(ref, df_aliases):
+    """
+    Finds the table and column of a column reference like "a.col", or
+    "col" for the first table of the query
+
+    Return:
+        (table, column), or None if error
+    """
+    alias, _, col = ref.strip().rpartition(".")
+    if alias and alias not in df_aliases:
+        print(f"ERROR: alias {alias} not assigned to a table")
+        return None
+    df = df_aliases[alias] if alias else list(df_aliases.values())[0]
+    if df not in TABLES:
+        print(f"ERROR: table {df} does not exist")
+        return None
+    if col not in TABLES[df].columns:
+        print(f"ERROR: column {col} does not exist in table {df}")
+        return None
+    return df, col
+
+def resolve_order(order, df_aliases, aggregate):
+    """
+    Resolves the ORDER BY column. An aggregating select is ordered on one of
+    its outputs, named by its label, its aggregate text or its column;
+    any other select is ordered on a column of its tables.
+
+    Return:
+        the order dictionary with "label" or "df" and "column" set, or 1 if error
+    """
+    ref = order["ref"]
+    if aggregate is not None:
+        for out in aggregate["outputs"]:
+            text = f"{out['func']}({out['column'] or '*'})"
+            if ref == out["label"] or ref.replace(" ","") == text or (out["func"] == "" and ref.rpartition(".")[2] == out["column"]):
+                return dict(order, label = out["label"])
+        print(f"ERROR: order by {ref} must be one of the selected columns")
+        return 1
+    found = resolve_column(ref, df_aliases)
+    if found is None:
+        return 1
+    return dict(order, df = found[0], column = found[1])
+
+def whole_table_rows(df, order, limit):
+    """
+    Row ids of every row of a table in ORDER BY order, cut to the LIMIT. A
+    sorted index on the order column already holds the row ids in order, and
+    without an ORDER BY the scan stops as soon as the LIMIT is reached.
+
+    Return:
+        list of row ids, or None if the table has no index to order by
+    """
+    tbl = TABLES[df]
+    bounds = (limit[0], limit[0] + limit[1]) if limit is not None else (None,)
+    if order is None:
+        rids = itertools.compress(range(len(tbl.live)), tbl.live)
+    else:
+        index = tbl.loaded_index(order["column"])
+        if index is None:
+            return None
+        rids = reversed(index.rids) if order["desc"] else index.rids
+    return list(itertools.islice(rids, *bounds))
+
+def order_rows(final_keys, order, limit):
+    """
+    Applies ORDER BY and LIMIT/OFFSET to the row ids of a select. With a
+    LIMIT only the first offset + n rows are kept, in a bounded heap, rather
+    than sorting every row.
+
+    Params:
+        final_keys: dictionary of table -> row ids, aligned across tables for a join
 
-        print("Time for", cmd, ": %s nanoseconds" % round(1000000000*(time.time() - start_time)))     
+    Return:
+        final_keys, ordered and cut
+    """
+    if order is None:
+        if limit is None:
+            return final_keys
+        return {df:rids[limit[0]:limit[0] + limit[1]] for df, rids in final_keys.items()}
 
-# region SELECT ########################################################################
-def process_select(cmd, do_print = True):
+    column = TABLES[order["df"]].store[order["column"]]
+    rids = final_keys[order["df"]]
+    # Order row ids for a single table, and positions in the row id lists for a join
+    if len(final_keys) == 1:
+        members, key = rids, column.__getitem__
+    else:
+        members, key = range(len(rids)), lambda i: column[rids[i]]
+    if limit is None:
+        members = sorted(members, key = key, reverse = order["desc"])
+    else:
+        top = heapq.nlargest if order["desc"] else heapq.nsmallest
+        members = top(limit[0] + limit[1], members, key = key)[limit[0]:]
+    if len(final_keys) == 1:
+        return {order["df"]:members}
+    return {df:[rids[i] for i in members] for df, rids in final_keys.items()}
 
-    # get columns, dfs, and where condition
-    col_list, dfs_list, where, join_list = get_df_col_and_where_list(cmd)
-    # get aggregation methods for columns to be gotten
-    col_funcs = get_col_funcs(col_list)
-    if col_funcs == 1:
-        return 1
-    if len(col_list) > 1 and list(col_funcs.values())[0]['agg'] != "":
-        print("ERROR: You cannot output more than one column with an aggregation function.")
-        return 1
+def order_output(final_output, order, limit):
+    # Applies ORDER BY and LIMIT/OFFSET to the rows of an aggregation
+    if order is None and limit is None:
+        return final_output
+    rows = range(len(next(iter(final_output.values()), [])))
+    if order is not None:
+        column = final_output[order["label"]]
+        # groups with a NULL aggregate sort first
+        rows = sorted(rows, key = lambda i: (column[i] is not None, column[i]), reverse = order["desc"])
+    if limit is not None:
+        rows = rows[limit[0]:limit[0] + limit[1]]
+    return {label:[values[i] for i in rows] for label, values in final_output.items()}
 
-    # get df alias names
-    df_aliases = get_df_aliases(dfs_list)
-    if df_aliases == 1:
-        return 1
-    
-    # create column dict that connects aliases
-    which_columns = get_which_columns(col_funcs, df_aliases, dfs_list)
-    if which_columns == 1:
-        return 1
+def get_group_by(cmd):
+    # Splits a trailing "group by col, col" off the query
+    match = re.search(r"\s+group\s+by\s+(.+)$", cmd, re.I)
+    if match is None:
+        return cmd, []
+    return cmd[:match.start()], [c.strip() for c in match.group(1).split(",")]
 
-    logic = ""
-    cond_columns = {}
-    if len(where)>0:
-        condition_dict = get_cond_dict(where, df_aliases)
-        if condition_dict == 1:
-            return 1
-        logic = condition_dict["logic"]
-        cond_columns = get_cond_columns(condition_dict, df_aliases)
-    dfs = []
-    for x in dfs_list:
-        dfs.append(x.split()[0])
-    #print(dfs)
-    #dfs = list(which_columns.keys())
-    #if cond_columns:
-    #    dfs += list(cond_columns.keys())
-    #dfs = list(set(dfs))
-    conjunctive = True
-    if logic == "or" or logic == "OR":
-        conjunctive = False
-    elif logic == "and" or logic == "AND":
-        conjunctive = True
+def get_aggregates(col_list, group_list, df_aliases):
+    """
+    Resolves the output of a select with aggregates or a group by. Each output
+    is a group by column or an aggregate: count(*), or count, sum, avg, min or max
+    of a column. Outputs are labeled by their "as" alias, else by the column name,
+    else, when two outputs share a column, by the aggregate text like "min(year)".
 
-    outDict = {}
-    for df in dfs:
-        outDict[df] = {
-            "logic":logic,
-            "columns to get":{},
-            "subset lists":[],
-            "subsetted":False
-        }
-        if df in which_columns:
-            outDict[df]["columns to get"] = which_columns[df]
-        
-        #move and optimizer here
-        if df in cond_columns:
-            outDict[df]["subset lists"] = [cond_columns[df][cond] for cond in cond_columns[df]]
-            outDict[df]["subsetted"] = True
-    # print(json.dumps(cond_columns, indent = 4))
-    #PROCESS JOINS
-    #and/or combination here
+    Return:
+        dictionary with "group", the (table, column) pairs to group on, and
+        "outputs", one dictionary per output column; or 1 if error
+    """
+    resolve = lambda ref: resolve_column(ref, df_aliases)
 
-    for df in dfs:
-        if len(outDict[df]["subset lists"]) > 1:
-            outDict[df]["subset lists"] = and_optimizer(cond_columns) if logic=="and" else or_optimizer(cond_columns)
-        elif len(outDict[df]["subset lists"]) == 1:
-            new_subset_lists = []
-            for l in outDict[df]["subset lists"]:
-                new_subset_lists.extend(l)
-            outDict[df]["subset lists"] = new_subset_lists
-
-    #okay, so we've outputted data from both of the tables, now I want to join what we've printed above:
-    join_cols = get_join_cols(join_list, df_aliases)
-    if logic == "and" or logic == "AND":
-        for df in dfs:
-            whiled = False
-            while len(outDict[df]["subset lists"]) > 1:
-                whiled = True
-                joined_cond_lists = which_join(df, df, outDict[df]["subset lists"][0], outDict[df]["subset lists"][1], join_cols[df], join_cols[df], conjunctive)
-                joined_cond_lists = [v for v in joined_cond_lists.values()]
-                outDict[df]["subset lists"][0] = joined_cond_lists[0]
-                outDict[df]["subset lists"].remove(outDict[df]["subset lists"][1])
-            if whiled:
-                new_subset_lists = []
-                for l in outDict[df]["subset lists"]:
-                    new_subset_lists.extend(l)
-                outDict[df]["subset lists"] = new_subset_lists
-  
-    #code to join tables (if necessary)
-    if len(dfs_list) > 1:
-        if outDict[dfs[0]]["subsetted"] is True:
-            temp1 = outDict[dfs[0]]["subset lists"]
-        else:
-            temp1 = list(TABLES[dfs[0]].table[(TABLES[dfs[0]].key)].keys())
-        if outDict[dfs[1]]["subsetted"] is True:
-            temp2 = outDict[dfs[1]]["subset lists"]
-        else:
-            temp2 = list(TABLES[dfs[1]].table[(TABLES[dfs[1]].key)].keys())
-        final_keys = which_join(dfs[0], dfs[1], temp1, temp2, join_cols[dfs[0]], join_cols[dfs[1]], conjunctive)
-    else:
-        if outDict[dfs[0]]["subsetted"] is True:
-            final_keys = {dfs[0]:outDict[dfs[0]]["subset lists"]}
+    group = []
+    for ref in group_list:
+        found = resolve(ref)
+        if found is None:
+            return 1
+        group.append(found)
+
+    outputs = []
+    for item in col_list:
+        label = None
+        match = re.match(r"(.*?)\s+as\s+(\S+)$", item, re.I)
+        if match:
+            item, label = match.group(1).strip(), match.group(2)
+        if "(" in item:
+            func = item.split("(")[0].strip().lower()
+            arg = item.split("(")[1].split(")")[0].strip()
+            if func not in ["count","sum","avg","min","max"]:
+                print(f"ERROR: aggregation method {func} not supported")
+                return 1
+            if arg == "*":
+                if func != "count":
+                    print(f"ERROR: {func}(*) is not supported, only count(*)")
+                    return 1
+                df, col = list(df_aliases.values())[0], None
+            else:
+                found = resolve(arg)
+                if found is None:
+                    return 1
+                df, col = found
+                if func in ["sum","avg"] and TABLES[df].dtypes[col]["cast"] is str:
+                    print("ERROR: Aggregation type not supported.")
+                    return 1
         else:
-            final_keys = {dfs[0]:list(TABLES[dfs[0]].table[TABLES[dfs[0]].key].keys())}
-            
-    #FINAL OUTPUT!
-    final_output = {}
-    #Handle aggregation operators (if any)
-    agg = False
-    for x in col_funcs.values():
-        if x['agg'] != "":
-            i = 0
-            agg = True
-            df = dfs[0]
-            column = list(outDict[df]["columns to get"].keys())[0]
-            final_keys = final_keys[df]
-            final_output[column] = []
-            for c in TABLES[df].columns:
-                if c == column:
-                    break
-                i = i + 1
-            if x['agg'].lower() == "min":
-                if column == TABLES[dfs[0]].key:
-                    minimum = min(final_keys)
-                else:
-                    minimum = find_data_type(dfs[0], column, "min")
-                    for k in final_keys:
-                        if TABLES[df].table[TABLES[df].key][k][column] < minimum:
-                            minimum = TABLES[df].table[TABLES[df].key][k][column]
-                final_output[column].append(minimum)
-            elif x['agg'].lower() == "max":
-                if column == TABLES[dfs[0]].key:
-                    maximum = max(final_keys)
-                else:
-                    maximum = find_data_type(dfs[0], column, "max")
-                    for k in final_keys:
-                        if TABLES[df].table[TABLES[df].key][k][column] > maximum:
-                            maximum = TABLES[df].table[TABLES[df].key][k][column]
-                final_output[column].append(maximum)
-            elif x['agg'].lower() == "avg":
-                average = find_data_type(dfs[0], column, "avg")
-                if average != 1:
-                    j = 0
-                    for k in final_keys:
-                        average = average + TABLES[df].table[TABLES[df].key][k][column]
-                        j = j + 1
-                    average = average / j
-                    final_output[column].append(average)
-            elif x['agg'].lower() == "sum":
-                sum_ = find_data_type(dfs[0], column, "sum")
-                if sum_ != 1:
-                    for k in final_keys:
-                        sum_ = sum_ + TABLES[df].table[TABLES[df].key][k][column]
-                    final_output[column].append(sum_)
-                
-    #Finds final output if there are no aggregation operators 
-    if agg is False:
-        for df in dfs:
-            for column in list(outDict[df]["columns to get"].keys()):
-                if column != TABLES[df].key:
-                    final_output[column] = [TABLES[df].table[TABLES[df].key][k][column] for k in final_keys[df]]
-                else:
-                    final_output[column] = [k for k in final_keys[df]]
-    if do_print:
-        print_output(final_output)
-    
-    return final_output
+            found = resolve(item)
+            if found is None:
+                return 1
+            if found not in group:
+                print(f"ERROR: column {item} must be aggregated or appear in the group by clause")
+                return 1
+            func = ""
+            df, col = found
+        outputs.append({"func":func, "df":df, "column":col, "label":label})
 
-def print_output(final_output):
-    #Takes the final output and prints it for the user (last step!)
-    table = PrettyTable()
+    names = [output["column"] for output in outputs]
+    for output in outputs:
+        if output["label"] is None:
+            if output["column"] and names.count(output["column"]) == 1:
+                output["label"] = output["column"]
+            else:
+                output["label"] = f"{output['func']}({output['column'] or '*'})"
+    return {"group":group, "outputs":outputs}
 
-    table.field_names = list(final_output.keys())
+def aggregate(spec, final_keys, whole = False):
+    """
+    Hash aggregation over the rows of a select. One pass over the group by
+    columns maps each group key to its rows, then each aggregate is computed
+    per group with the builtin sum/min/max streaming over the group's values.
+    Grouping a whole table on one non-key column skips the pass, since the
+    column index already maps each value to its rows.
 
-    final_rows = list(map(list, zip(*final_output.values())))
+    Params:
+        spec: the aggregate dictionary from get_aggregates
+        final_keys: dictionary of table -> row ids, aligned across tables for a join
+        whole: True if final_keys holds every row of a single table
 
-    for row in final_rows:
-        table.add_row(row)
-    print(table)
+    Return:
+        dictionary of output label -> list of values, one per group
+    """
+    group = spec["group"]
+    dfs = list(final_keys)
+    single = len(dfs) == 1
 
-def find_data_type(df, c, string):
-    #Used for aggregation operators: gets the datatype of the operator and returns appropriate type and value
-    for column in TABLES[df].dtypes:
-        if c == column:
-            if TABLES[df].dtypes[column]['cast'] == str:
-                if string == "min":
-                    dtype = "ZZZZZZZZZZZ"
-                elif string == "sum" or string == "avg":
-                    print("ERROR: Aggregation type not supported.")
-                    return 1
-                else:
-                    dtype = ""
-            elif TABLES[df].dtypes[column]['cast'] == int:
-                if string == "min":
-                    dtype = 999999999999
-                else:
-                    dtype = 0
-            elif TABLES[df].dtypes[column]['cast'] == float:
-                if string == "min":
-                    dtype = sys.float_info.max
+    # Group members are row ids for a single table,
+    # and positions in the aligned row id lists for a join
+    if not group:
+        groups = {():final_keys[dfs[0]] if single else range(len(final_keys[dfs[0]]))}
+    elif whole and len(group) == 1 and group[0][1] != TABLES[group[0][0]].key:
+        TABLES[group[0][0]].compact(group[0][1])
+        groups = TABLES[group[0][0]].table[group[0][1]]
+    else:
+        members = final_keys[dfs[0]] if single else range(len(final_keys[dfs[0]]))
+        columns = [TABLES[df].store[col].take(final_keys[df]) for df, col in group]
+        keys = columns[0] if len(columns) == 1 else zip(*columns)
+        groups = {}
+        for key, member in zip(keys, members):
+            rows = groups.get(key)
+            if rows is None:
+                groups[key] = [member]
+            else:
+                rows.append(member)
+
+    output = {out["label"]:[] for out in spec["outputs"]}
+    for key, members in groups.items():
+        if group and not members:
+            continue
+        for out in spec["outputs"]:
+            func = out["func"]
+            if func == "":
+                value = key if len(group) == 1 else key[group.index((out["df"], out["column"]))]
+            elif func == "count":
+                value = len(members)
+            else:
+                rids = members if single else map(final_keys[out["df"]].__getitem__, members)
+                values = TABLES[out["df"]].store[out["column"]].take(rids)
+                if not members:
+                    value = None
+                elif func == "sum":
+                    value = sum(values)
+                elif func == "avg":
+                    value = sum(values) / len(members)
+                elif func == "min":
+                    value = min(values)
                 else:
-                    dtype = 0.0
-    return dtype
+                    value = max(values)
+            output[out["label"]].append(value)
+    return output
+
+def index_aggregate(spec, df):
+    """
+    Answers aggregates over every row of a table without fetching rows.
+    COUNT is the row count, MIN and MAX are the ends of a sorted index on
+    the column, or else the smallest and largest values of its value -> rows
+    index, which holds one entry per distinct value.
+
+    Return:
+        dictionary of output label -> [value], or None if an aggregate
+        needs the rows (sum, avg or a group by)
+    """
+    if spec["group"]:
+        return None
+    tbl = TABLES[df]
+    output = {}
+    for out in spec["outputs"]:
+        func, col = out["func"], out["column"]
+        if func == "count":
+            value = tbl.nrow
+        elif func not in ["min","max"]:
+            return None
+        elif tbl.nrow == 0:
+            value = None
+        else:
+            index = tbl.loaded_index(col)
+            if index is not None:
+                value = index.values[0] if func == "min" else index.values[-1]
+            elif "table" in tbl.pending:
+                # building the value index would read every row anyway
+                return None
+            else:
+                value = min(tbl.table[col]) if func == "min" else max(tbl.table[col])
+        output[out["label"]] = [value]
+    return output
 
 def get_df_col_and_where_list(cmd):
     tokens = cmd.split()
@@ -675,25 +3162,17 @@ def get_df_col_and_where_list(cmd):
     return col_list, dfs_list, where_list, join_list
 
 def get_col_funcs(col_list):
+    # Aggregated selects go through get_aggregates, so these are plain columns
     col_funcs = {}
     for col in col_list:
         name = col
-        agg = ""
         alias = name
-        if "(" in col:
-            agg = col.split("(")[0].lower().strip()
-            if agg not in ["min","max","sum","avg"]:
-                print(f"ERROR: aggregation method {agg} not supported")
-                return 1
-            name = col.split("(")[1].split(")")[0].strip()
-        
         for tp in ["as","AS","As"]:
             if f" {tp} " in col:
                 alias = col.split(tp)[-1].strip()
                 break
         
         col_funcs[name] = {
-            "agg":agg,
             "alias":alias
         }
     return col_funcs
@@ -743,7 +3222,7 @@ def get_which_columns(col_funcs, df_aliases, dfs_list):
             return 1
         else:
             if "*" in which_columns[df]:
-                which_columns[df] = {c:{"agg":"","alias":c} for c in TABLES[df].columns}
+                which_columns[df] = {c:{"alias":c} for c in TABLES[df].columns}
             else:
                 for col in which_columns[df]:
                     if col not in TABLES[df].columns:
@@ -767,6 +3246,106 @@ def get_join_cols(join_list, df_aliases):
 
     return which_join_cols
 
+def split_top_level(string, delim):
+    # Splits string on delim (e.g. " or ", any case) wherever it is outside parentheses and quotes
+    parts = []
+    lower = string.lower()
+    depth = 0
+    quote = ""
+    start = 0
+    i = 0
+    while i < len(string):
+        ch = string[i]
+        if quote:
+            if ch == quote:
+                quote = ""
+        elif ch in "'\"":
+            quote = ch
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif depth == 0 and lower.startswith(delim, i):
+            parts.append(string[start:i])
+            i += len(delim)
+            start = i
+            continue
+        i += 1
+    parts.append(string[start:])
+    return [p.strip() for p in parts]
+
+def parse_where(where):
+    """
+    Parses a where clause into a tree of {"op":"or"/"and"/"not", "children":[...]}
+    and {"op":"cond", "cond":text} nodes. "or" binds loosest, then "and",
+    then a leading "not"; parentheses group sub-expressions.
+
+    Params:
+        where: the where clause string
+    """
+    where = where.strip()
+    for op in ["or","and"]:
+        parts = split_top_level(where, f" {op} ")
+        if len(parts) > 1:
+            return {"op":op, "children":[parse_where(p) for p in parts]}
+    if where.lower().startswith("not "):
+        return {"op":"not", "children":[parse_where(where[4:])]}
+    if where.startswith("(") and where.endswith(")"):
+        # Only strip the parentheses if they enclose the whole clause
+        depth = 0
+        for i, ch in enumerate(where):
+            depth += (ch == "(") - (ch == ")")
+            if depth == 0 and i < len(where) - 1:
+                break
+        else:
+            return parse_where(where[1:-1])
+    return {"op":"cond", "cond":where}
+
+def where_leaves(node):
+    # Returns the condition strings at the leaves of a where tree
+    if node["op"] == "cond":
+        return [node["cond"]]
+    return [leaf for child in node["children"] for leaf in where_leaves(child)]
+
+def split_where_tree(node, preds):
+    """
+    Splits a where tree into one tree per table. Conditions joined by
+    "and" can be split between tables, but "or" and "not" must only
+    combine conditions on a single table.
+
+    Params:
+        node: a where tree from parse_where
+        preds: dictionary of condition string -> predicate dictionary
+
+    Return:
+        dictionary of table -> tree with {"op":"pred", "pred":...} leaves, or 1 if error
+    """
+    if node["op"] == "cond":
+        if node["cond"] not in preds:
+            print(f"ERROR: invalid conditional statement in {node['cond']}")
+            return 1
+        return {preds[node["cond"]]["df"]:{"op":"pred", "pred":preds[node["cond"]]}}
+
+    children = [split_where_tree(child, preds) for child in node["children"]]
+    if any(child == 1 for child in children):
+        return 1
+
+    if node["op"] == "and":
+        out = {}
+        for child in children:
+            for df, sub in child.items():
+                if df not in out:
+                    out[df] = {"op":"and", "children":[]}
+                out[df]["children"] += sub["children"] if sub["op"] == "and" else [sub]
+        return {df:(sub["children"][0] if len(sub["children"]) == 1 else sub) for df, sub in out.items()}
+
+    dfs = set(df for child in children for df in child)
+    if len(dfs) > 1:
+        print(f"ERROR: conditions combined with {node['op']} must all refer to the same table")
+        return 1
+    df = dfs.pop()
+    return {df:{"op":node["op"], "children":[child[df] for child in children]}}
+
 def get_cond_dict(where, df_aliases):
     condition_dict = {
         "logic":"",
@@ -893,103 +3472,395 @@ def get_cond_dict(where, df_aliases):
             return 1
     return condition_dict
 
-def get_cond_columns(c, df_aliases):
-    # arithmetic
-    cond_list = {}
+class VectorizeBoolOps(ast.NodeTransformer):
+    """
+    Rewrites the boolean parts of a condition so that it can be applied to
+    whole NumPy arrays: and/or become &/|, not x becomes x == 0 and chained
+    comparisons are split into a conjunction of single comparisons.
+    """
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+        return functools.reduce(lambda left, right: ast.BinOp(left, op, right), node.values)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.Compare(node.operand, [ast.Eq()], [ast.Constant(0)])
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        parts = []
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            parts.append(ast.Compare(left, [op], [right]))
+            left = right
+        return functools.reduce(lambda l, r: ast.BinOp(l, ast.BitAnd(), r), parts)
+
+@functools.lru_cache(maxsize = 256)
+def compile_predicate(cond, variables, vectorized = False):
+    """
+    Compiles a condition into a reusable function once, instead of
+    evaluating its AST for every value. The result is cached on the
+    condition text, so repeated queries (including the selects made
+    by update and delete) reuse the same function.
+
+    Params:
+        cond: the condition string, with "." in column names replaced by "___"
+        variables: tuple of the variable names, in the order the function takes them
+        vectorized: if True, the function takes NumPy arrays and returns a boolean mask
+
+    Return:
+        a function taking one positional argument per variable
+    """
+    body = ast.parse(cond, mode = "eval").body
+    if vectorized:
+        body = VectorizeBoolOps().visit(body)
+    args = ast.arguments(posonlyargs = [], args = [ast.arg(arg = v) for v in variables],
+                         kwonlyargs = [], kw_defaults = [], defaults = [])
+    func = ast.fix_missing_locations(ast.Expression(ast.Lambda(args = args, body = body)))
+    return eval(compile(func, filename = "<where>", mode = "eval"), {})
+
+INT64_MIN, INT64_MAX = -(1 << 63), (1 << 63) - 1
+
+@functools.lru_cache(maxsize = 256)
+def cond_tree(cond):
+    # Parses a condition once for may_overflow, or returns None if it does no arithmetic
+    tree = ast.parse(cond, mode = "eval").body
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.BinOp, ast.Call)) or isinstance(node, ast.UnaryOp) and not isinstance(node.op, ast.Not):
+            return tree
+    return None
+
+def int_range(node, bounds):
+    """
+    Interval arithmetic over a condition: the (low, high) an int valued node
+    can take given the (low, high) of each int column, or None for a float
+    or boolean node. Raises OverflowError if an int value can leave the
+    int64 range, or if the range of a node cannot be worked out.
+    """
+    if isinstance(node, ast.Name):
+        return bounds[node.id]
+    if isinstance(node, ast.Constant):
+        return (node.value, node.value) if isinstance(node.value, int) else None
+    if isinstance(node, ast.Compare):
+        for child in [node.left] + node.comparators:
+            int_range(child, bounds)
+        return None
+    if isinstance(node, ast.BoolOp):
+        for child in node.values:
+            int_range(child, bounds)
+        return None
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        int_range(node.operand, bounds)
+        return None
+    if isinstance(node, ast.UnaryOp):
+        r = int_range(node.operand, bounds)
+        if r is None or isinstance(node.op, ast.UAdd):
+            return r
+        if isinstance(node.op, ast.USub):
+            low, high = -r[1], -r[0]
+        else:
+            low, high = ~r[1], ~r[0]
+    elif isinstance(node, ast.BinOp):
+        left, right = int_range(node.left, bounds), int_range(node.right, bounds)
+        if left is None or right is None or isinstance(node.op, ast.Div):
+            return None
+        (a, b), (c, d) = left, right
+        size = max(abs(a), abs(b))
+        if isinstance(node.op, ast.Add):
+            low, high = a + c, b + d
+        elif isinstance(node.op, ast.Sub):
+            low, high = a - d, b - c
+        elif isinstance(node.op, ast.Mult):
+            corners = [a * c, a * d, b * c, b * d]
+            low, high = min(corners), max(corners)
+        elif isinstance(node.op, (ast.Pow, ast.LShift)):
+            if c < 0 or d > 64 and size > 1:
+                raise OverflowError
+            top = size ** d if isinstance(node.op, ast.Pow) else size << d
+            low, high = -top, top
+        elif isinstance(node.op, ast.Mod):
+            top = max(abs(c), abs(d))
+            low, high = -top, top
+        elif isinstance(node.op, ast.FloorDiv):
+            # INT64_MIN // -1 is the one quotient larger than its dividend
+            low, high = -size, size
+        else:
+            # &, |, ^ and >> stay within twice the larger operand
+            top = 2 * max(size, abs(c), abs(d)) + 1
+            low, high = -top, top
+    else:
+        raise OverflowError
+    if low < INT64_MIN or high > INT64_MAX:
+        raise OverflowError
+    return low, high
+
+def may_overflow(cond, variables, arrays):
+    """
+    Returns whether a condition's int arithmetic could leave the int64 range
+    for the values in the column arrays, where NumPy wraps around but Python
+    ints keep growing. The check uses each int column's min and max.
+    """
+    tree = cond_tree(cond)
+    if tree is None:
+        return False
+    bounds = {}
+    for var, arr in zip(variables, arrays):
+        if arr.dtype.kind != "i":
+            bounds[var] = None
+        elif len(arr):
+            bounds[var] = (int(arr.min()), int(arr.max()))
+        else:
+            bounds[var] = (0, 0)
+    try:
+        int_range(tree, bounds)
+    except OverflowError:
+        return True
+    return False
+
+def vectorized_filter(df, cond, variables, columns):
+    """
+    Evaluates an arithmetic condition over whole column arrays with NumPy
+
+    Params:
+        df: name of the table being conditioned
+        cond: the condition string, with "." in column names replaced by "___"
+        variables: tuple of the variable names in the condition
+        columns: the column each variable refers to
+
+    Return:
+        Bitmap of matching row ids, or None if the condition cannot be vectorized
+        the same way the row by row path evaluates it
+    """
+    tbl = TABLES[df]
+    predicate = compile_predicate(cond, variables, vectorized = True)
+    try:
+        # Float overflow and division by zero fall back to the row by row path
+        with np.errstate(all = "raise"):
+            if len(columns) == 1 and isinstance(tbl.store[columns[0]], VarcharColumn):
+                # Test each distinct string once, then map the result onto rows through the codes
+                col = tbl.store[columns[0]]
+                mask = np.asarray(predicate(np.array(col.dictionary, dtype = object)), dtype = bool)
+                mask = mask[np.frombuffer(col.codes, dtype = "i")]
+            else:
+                arrays = [tbl.store[col].to_numpy() for col in columns]
+                if may_overflow(cond, variables, arrays):
+                    # Integer arithmetic is done on Python ints, so it cannot wrap
+                    arrays = [arr.astype(object) if arr.dtype.kind == "i" else arr for arr in arrays]
+                mask = np.asarray(predicate(*arrays), dtype = bool)
+            mask = np.broadcast_to(mask, len(tbl.live)) & (np.frombuffer(tbl.live, dtype = np.uint8) != 0)
+    except (TypeError, ValueError, ZeroDivisionError, OverflowError, FloatingPointError):
+        return None
+    return Bitmap.from_mask(mask)
+
+def get_predicates(c, df_aliases):
+    """
+    Flattens the condition dictionary into a list with one entry per
+    condition, holding the table it filters and the columns it reads
+
+    Params:
+        c: the condition dictionary from get_cond_dict
+        df_aliases: dictionary of df alias -> table name
+
+    Return:
+        list of predicate dictionaries, or 1 if error
+    """
+    predicates = []
     for cond in c["arithmetic"]:
         df = ""
         for var in c["arithmetic"][cond]:
             if df and df != df_aliases[c["arithmetic"][cond][var]["df_alias"]]:
                 print(f"ERROR: trying to perform subsetting with condition that references multiple tables")
+                return 1
             elif not df:
                 df = df_aliases[c["arithmetic"][cond][var]["df_alias"]]
+        predicates.append({
+            "cond":cond.replace("___","."),
+            "df":df,
+            "kind":"arithmetic",
+            "expr":cond,
+            "variables":tuple(c["arithmetic"][cond].keys()),
+            "columns":[c["arithmetic"][cond][var]["column"] for var in c["arithmetic"][cond]]
+        })
+    for cond in c["string"]["ins"]:
+        predicates.append({
+            "cond":cond,
+            "df":df_aliases[c["string"]["ins"][cond]["df_alias"]],
+            "kind":"in",
+            "columns":[c["string"]["ins"][cond]["columns"]],
+            "eval":c["string"]["ins"][cond]["eval"],
+            "list":c["string"]["ins"][cond]["list"]
+        })
+    for cond in c["string"]["likes"]:
+        predicates.append({
+            "cond":cond,
+            "df":df_aliases[c["string"]["likes"][cond]["df_alias"]],
+            "kind":"like",
+            "columns":[c["string"]["likes"][cond]["columns"]],
+            "eval":c["string"]["likes"][cond]["eval"],
+            "type":c["string"]["likes"][cond]["type"],
+            "compare":c["string"]["likes"][cond]["compare"]
+        })
+    return predicates
 
-        if df not in cond_list:
-            cond_list[df] = {}
-        cond_back = cond.replace("___",".")
-        cond_list[df][cond_back] = []
+def like_matcher(pred):
+    # Returns a function testing one value against a like predicate
+    compare = pred["compare"]
+    if pred["type"] == "within":
+        return lambda val: (compare in val) == pred["eval"]
+    elif pred["type"] == "end":
+        return lambda val: val.endswith(compare) == pred["eval"]
+    return lambda val: val.startswith(compare) == pred["eval"]
 
-        parsed = ast.parse(cond, mode='eval')
-        if len(c["arithmetic"][cond]) == 1: # Can just condition if only one variable is considered
-            var = list(c["arithmetic"][cond].keys())[0]
-            column = c["arithmetic"][cond][var]["column"]
-            isKey = (column == TABLES[df].key)
-            
-            for val in TABLES[df].table[column]:
-                if eval(compile(parsed, filename='<string>', mode='eval'), {}, {var:val}):
-                    if isKey:
-                        cond_list[df][cond_back].append(val)
-                    else:
-                        cond_list[df][cond_back].extend(TABLES[df].table[column][val])
-        else: # Otherwise we need to actually just scan each value
-            var_col_dict = {var:c["arithmetic"][cond][var]["column"] for var in c["arithmetic"][cond]}
-            for key in TABLES[df].table[TABLES[df].key]:
-                params = {var:TABLES[df].table[TABLES[df].key][key][var_col_dict[var]] for var in var_col_dict}
-                if eval(compile(parsed, filename='<string>', mode='eval'), {}, params):
-                    cond_list[df][cond_back].append(key)
-    # ins
-    for cond in c["string"]["ins"]:
-        df = df_aliases[c["string"]["ins"][cond]["df_alias"]]
-
-        if df not in cond_list:
-            cond_list[df] = {}
-        cond_list[df][cond] = []
-
-        column = c["string"]["ins"][cond]["columns"]
-        isKey = (column == TABLES[df].key)
-        if c["string"]["ins"][cond]["eval"]:
-            for val in c["string"]["ins"][cond]["list"]:
-                if val in TABLES[df].table[column]:
-                    if isKey:
-                        cond_list[df][cond].append(val)
-                    else:
-                        cond_list[df][cond].extend(TABLES[df].table[column][val])
+def access_paths(pred):
+    """
+    Lists the ways a predicate can be evaluated over a whole table:
+        "bitmap": OR the bitmaps of a bitmap index for ==, !=, IN and NOT IN
+        "index": bisect a sorted index on the column
+        "lookup": fetch the value, or each value of an IN list, from the column index
+        "vectorized": evaluate over the column arrays with NumPy
+        "values": test each distinct value in the column index
+        "rows": test every row
+    """
+    tbl = TABLES[pred["df"]]
+    col = pred["columns"][0]
+    single = len(pred["columns"]) == 1
+    bounds = index_range(pred["expr"], pred["variables"][0]) if pred["kind"] == "arithmetic" and single else None
+    paths = []
+    if tbl.loaded_index(col, "bitmap_indexes") is not None and (pred["kind"] == "in" or bounds is not None and bounds[0] in ["==","!="]):
+        paths.append("bitmap")
+    if pred["kind"] == "in":
+        return paths + (["lookup", "values", "rows"] if pred["eval"] else ["values", "rows"])
+    if pred["kind"] == "like":
+        return paths + ["values", "rows"]
+    if bounds is not None and bounds[0] == "==":
+        paths.append("lookup")
+    # Indexes of a reopened table are not built just to be costed
+    if bounds is not None and tbl.loaded_index(col) is not None:
+        paths.append("index")
+    if SETTINGS["vectorized"]:
+        paths.append("vectorized")
+    if single:
+        paths.append("values")
+    return paths + ["rows"]
+
+def access_path(pred, estimate = None):
+    """
+    Picks the cheapest access path for a predicate by scan_cost, the first
+    listed by access_paths winning ties
+
+    Params:
+        pred: a predicate dictionary from get_predicates
+        estimate: the estimate_rows of the predicate, if already known
+    """
+    estimate = estimate_rows(pred) if estimate is None else estimate
+    return min(access_paths(pred), key = lambda access: scan_cost(pred, access, estimate))
+
+def scan_predicate(pred, access = None):
+    """
+    Evaluates a predicate over its whole table
+
+    Params:
+        pred: a predicate dictionary from get_predicates
+        access: the access path to use, see access_path
+
+    Return:
+        Bitmap of the matching row ids
+    """
+    rids = scan_predicate_rids(pred, access)
+    return rids if isinstance(rids, Bitmap) else Bitmap.from_rids(rids)
+
+def scan_predicate_rids(pred, access = None):
+    # Runs the access path for scan_predicate, which may produce a row id list or a Bitmap
+    df = pred["df"]
+    tbl = TABLES[df]
+    access = access or access_path(pred)
+
+    if access == "bitmap":
+        index = tbl.bitmap_indexes[pred["columns"][0]]
+        if pred["kind"] == "in":
+            values, negate = pred["list"], not pred["eval"]
         else:
-            for val in TABLES[df].table[column]:
-                if val not in c["string"]["ins"][cond]["list"]:
-                    if isKey:
-                        cond_list[df][cond].append(val)
-                    else:
-                        cond_list[df][cond].extend(TABLES[df].table[column][val])
+            op, val = index_range(pred["expr"], pred["variables"][0])
+            values, negate = [val], op == "!="
+        if negate:
+            return tbl.live_bitmap() - index.lookup(values)
+        return index.lookup(values)
 
-        cond_list[df][cond] = list(set(cond_list[df][cond]))
+    if pred["kind"] == "arithmetic":
+        if access == "lookup":
+            return list(tbl.rows_with(pred["columns"][0], index_range(pred["expr"], pred["variables"][0])[1]))
+        if access == "index":
+            try:
+                return tbl.indexes[pred["columns"][0]].lookup(*index_range(pred["expr"], pred["variables"][0]))
+            except TypeError:
+                access = "values"
+        if access == "vectorized":
+            rids = vectorized_filter(df, pred["expr"], pred["variables"], pred["columns"])
+            if rids is not None:
+                return rids
+            access = "values" if len(pred["columns"]) == 1 and "table" not in tbl.pending else "rows"
 
-    # likes
-    for cond in c["string"]["likes"]:
-        df = df_aliases[c["string"]["likes"][cond]["df_alias"]]
+        predicate = compile_predicate(pred["expr"], pred["variables"])
+        if access == "rows":
+            var_cols = [tbl.store[col] for col in pred["columns"]]
+            return [rid for rid in tbl.row_ids() if predicate(*[col[rid] for col in var_cols])]
+        test = predicate
+    elif pred["kind"] == "in":
+        if access == "lookup":
+            rids = []
+            for val in set(pred["list"]):
+                rids.extend(tbl.rows_with(pred["columns"][0], val))
+            return rids
+        test = lambda val: (val in pred["list"]) == pred["eval"]
+    else:
+        test = like_matcher(pred)
 
-        if df not in cond_list:
-            cond_list[df] = {}
+    column = pred["columns"][0]
+    if access == "rows":
+        # Test every row, or for a varchar column each distinct string once
+        store = tbl.store[column]
+        if isinstance(store, VarcharColumn):
+            hits = {code for code, val in enumerate(store.dictionary) if test(val)}
+            codes = store.codes
+            return [rid for rid in tbl.row_ids() if codes[rid] in hits]
+        return [rid for rid in tbl.row_ids() if test(store[rid])]
 
-        column = c["string"]["likes"][cond]["columns"]
-        isKey = (column == TABLES[df].key)
-        cond_list[df][cond] = []
+    # Can just condition each distinct value if only one column is considered
+    rids = []
+    for val in tbl.table[column]:
+        if test(val):
+            rids.extend(tbl.rows_with(column, val))
+    return rids
 
-        compare = c["string"]["likes"][cond]["compare"]
-        tp = c["string"]["likes"][cond]["type"]
+def filter_predicate(pred, rids):
+    """
+    Keeps the row ids from rids that satisfy a predicate, testing each row directly
 
-        if tp == "within":
-            for val in TABLES[df].table[column]:
-                if (compare in val) == c["string"]["likes"][cond]["eval"]:
-                    if isKey:
-                        cond_list[df][cond].append(val)
-                    else:
-                        cond_list[df][cond].extend(TABLES[df].table[column][val])
-        elif tp == "end":
-            for val in TABLES[df].table[column]:
-                if val.endswith(compare) == c["string"]["likes"][cond]["eval"]:
-                    if isKey:
-                        cond_list[df][cond].append(val)
-                    else:
-                        cond_list[df][cond].extend(TABLES[df].table[column][val])
-        elif tp == "start":
-            for val in TABLES[df].table[column]:
-                if val.startswith(compare) == c["string"]["likes"][cond]["eval"]:
-                    if isKey:
-                        cond_list[df][cond].append(val)
-                    else:    
-                        cond_list[df][cond].extend(TABLES[df].table[column][val])
-    return cond_list
+    Params:
+        pred: a predicate dictionary from get_predicates
+        rids: list of candidate row ids
+
+    Return:
+        list of the matching row ids
+    """
+    tbl = TABLES[pred["df"]]
+    var_cols = [tbl.store[col] for col in pred["columns"]]
+    if pred["kind"] == "arithmetic":
+        predicate = compile_predicate(pred["expr"], pred["variables"])
+        if len(var_cols) == 1:
+            return [rid for rid in rids if predicate(var_cols[0][rid])]
+        return [rid for rid in rids if predicate(*[col[rid] for col in var_cols])]
+    elif pred["kind"] == "in":
+        members = set(pred["list"])
+        return [rid for rid in rids if (var_cols[0][rid] in members) == pred["eval"]]
+    test = like_matcher(pred)
+    return [rid for rid in rids if test(var_cols[0][rid])]
 # endregion SELECT #####################################################################
 # region OPTIMIZATION ########################################################################
 def get_input():
@@ -998,13 +3869,37 @@ def get_input():
         command += " "+input("> ")
     return [c.strip() for c in command.split(";") if c]
 
-def which_join(df1, df2, data1, data2, col1, col2, conjunctive):
-    #This function determines using cost-based optimization whether we should call merge_scan or nested_loop
+def choose_join(df1, df2, n1, n2, col1, col2):
+    #This function determines using cost-based optimization whether we should call hash_join, merge_scan or nested_loop,
+    #given the (estimated) number of rows on each side, and which side hash_join should build its hash table on
+    n1 = max(n1, 1)
+    n2 = max(n2, 1)
+    #A side with a sorted index on its join column is already ordered and skips the sort
+    sort1 = 0 if TABLES[df1].loaded_index(col1) is not None else n1 * math.log(n1, 2)
+    sort2 = 0 if TABLES[df2].loaded_index(col2) is not None else n2 * math.log(n2, 2)
+    costs = {
+        "hash":2 * min(n1, n2) + max(n1, n2),
+        "merge":sort1 + sort2 + n1 + n2,
+        "nested":n1 * n2
+    }
+    algorithm = min(costs, key = costs.get)
+    return {
+        "algorithm":algorithm,
+        "build":df1 if n1 <= n2 else df2,
+        "build_first":n1 <= n2,
+        "cost":costs[algorithm]
+    }
+
+def which_join(df1, df2, data1, data2, col1, col2, conjunctive, join_plan = None):
+    #Runs the join picked by choose_join, or by the planner if it already chose one
     if len(data1) == 0 or len(data2) == 0:
         return {df1:[],df2:[]}
-    merge_cost = len(data1) * math.log(len(data1), 2) + len(data2) * math.log(len(data2), 2) + len(data1) + len(data2)
-    nested_cost = len(data1) * len(data2)
-    if merge_cost < nested_cost:
+    if join_plan is None:
+        join_plan = choose_join(df1, df2, len(data1), len(data2), col1, col2)
+    if join_plan["algorithm"] == "hash":
+        lol = hash_join(df1, df2, data1, data2, col1, col2, conjunctive, join_plan["build_first"])
+        return {df1:lol[0],df2:lol[1]}
+    if join_plan["algorithm"] == "merge":
         lol = merge_scan(df1, df2, data1, data2, col1, col2, conjunctive)
         return {df1:lol[0],df2:lol[1]}
     if len(data1) < len(data2):
@@ -1016,64 +3911,341 @@ def which_join(df1, df2, data1, data2, col1, col2, conjunctive):
 def nested_loop(df1, df2, data1, data2, col1, col2, conjunctive):
     keys1 = []
     keys2 = []
+    values1 = TABLES[df1].store[col1]
+    values2 = TABLES[df2].store[col2]
     for i in data1:
         for j in data2:
                 #if conjunctive:
-                    if col1 == TABLES[df1].key and col2 == TABLES[df2].key:
+                    if df1 == df2 and col1 == TABLES[df1].key and col2 == TABLES[df2].key:
                         if i == j:
                             keys1.append(i)
                             keys2.append(j)
                     else:
-                        if TABLES[df1].table[TABLES[df1].key][i][col1] == TABLES[df2].table[TABLES[df2].key][j][col2]:
+                        if values1[i] == values2[j]:
                             keys1.append(i)
                             keys2.append(j)
     return [keys1, keys2]
 
+def hash_join(df1, df2, data1, data2, col1, col2, conjunctive, build_first = None):
+    #Builds a hash table of join value -> row ids on the smaller side (or the side the planner
+    #chose), then probes it with the other side. Every row id is paired with every matching
+    #row id, so duplicate join values on both sides (many-to-many) produce their full cross product
+    keys1 = []
+    keys2 = []
+    if build_first is None:
+        build_first = len(data1) <= len(data2)
+    if build_first:
+        build, build_values, probe, probe_values = data1, TABLES[df1].store[col1], data2, TABLES[df2].store[col2]
+    else:
+        build, build_values, probe, probe_values = data2, TABLES[df2].store[col2], data1, TABLES[df1].store[col1]
+
+    buckets = {}
+    for rid in build:
+        val = build_values[rid]
+        if val in buckets:
+            buckets[val].append(rid)
+        else:
+            buckets[val] = [rid]
+
+    for rid in probe:
+        matches = buckets.get(probe_values[rid])
+        if matches:
+            if build_first:
+                keys1.extend(matches)
+                keys2.extend([rid] * len(matches))
+            else:
+                keys1.extend([rid] * len(matches))
+                keys2.extend(matches)
+    return [keys1, keys2]
+
+def sorted_join_input(df, data, col):
+    #Returns the row ids in data and their col values, ordered by value. If col has a sorted
+    #index, the index order is filtered down to data instead of sorting it again
+    values = TABLES[df].store[col]
+    index = TABLES[df].loaded_index(col)
+    if index is not None and len(data) * math.log(max(len(data), 2), 2) > len(index.rids):
+        members = set(data)
+        rids = [rid for rid in index.rids if rid in members]
+    else:
+        rids = sorted(data, key = values.__getitem__)
+    return rids, [values[rid] for rid in rids]
+
 def merge_scan(df1, df2, data1, data2, col1, col2, conjunctive):
+    #Sort-merge join on col1 == col2: both sides are ordered by join value, then for each
+    #value found on both sides the cross product of the two runs of equal values is emitted
     keys1 = []
     keys2 = []
     i = 0
     j = 0
-    data1 = sorted(data1)
-    data2 = sorted(data2)
+    data1, values1 = sorted_join_input(df1, data1, col1)
+    data2, values2 = sorted_join_input(df2, data2, col2)
     while i < len(data1) and j < len(data2):
-        if data1[i] < data2[j]:
+        if values1[i] < values2[j]:
             i = i + 1
-        elif data1[i] > data2[j]:
+        elif values1[i] > values2[j]:
             j = j + 1
         else:
-            keys1.append(data1[i])
-            keys2.append(data2[j])
-            i = i + 1
-            j = j + 1
+            i_end = i + 1
+            while i_end < len(data1) and values1[i_end] == values1[i]:
+                i_end = i_end + 1
+            j_end = j + 1
+            while j_end < len(data2) and values2[j_end] == values2[j]:
+                j_end = j_end + 1
+            for k in range(i, i_end):
+                keys1.extend([data1[k]] * (j_end - j))
+                keys2.extend(data2[j:j_end])
+            i = i_end
+            j = j_end
     return [keys1, keys2]
 
-def and_optimizer(cond_columns):
-    dfs = []
-    if cond_columns:
-        dfs += list(cond_columns.keys())
-    dfs = list(set(dfs))
-    for df in dfs:
-        if df in cond_columns:
-            subset = [cond_columns[df][cond] for cond in cond_columns[df]]
-    sorted_cond_columns = sorted(subset, key = len)
-    return sorted_cond_columns
+def analyze_table(tokens):
+    """
+    Function to collect planner statistics, e.g. "analyze table df2"
 
-def or_optimizer(cond_columns):
-    dfs = []
-    if cond_columns:
-        dfs += list(cond_columns.keys())
-    dfs = list(set(dfs))
-    subset = []
+    Params:
+        tokens: the tokenized command, without the leading "analyze"
+    """
+    names = [t for t in tokens if t.lower() != "table"]
+    if not names:
+        print("ERROR: analyze query not properly formatted")
+        return 1
+    for name in names:
+        name = name.strip(",")
+        if name not in TABLES:
+            print(f"ERROR: table {name} does not exist")
+            return 1
+        TABLES[name].analyze()
+    return 0
+
+def estimate_rows(pred):
+    """
+    Estimates how many rows satisfy a predicate without evaluating it.
+    Range conditions use an exact count from a sorted index if there is one,
+    otherwise the histogram collected by analyze; equality and IN use the
+    distinct count.
+    """
+    tbl = TABLES[pred["df"]]
+    nrow = tbl.nrow
+    col = pred["columns"][0]
+    distinct = tbl.stats[col]["distinct"] if col in tbl.stats else tbl.distinct(col)
+    distinct = max(distinct, 1)
+
+    if pred["kind"] == "in":
+        selectivity = min(1, len(set(pred["list"])) / distinct)
+        return nrow * (selectivity if pred["eval"] else 1 - selectivity)
+    if pred["kind"] == "like":
+        return nrow * (0.1 if pred["eval"] else 0.9)
+
+    bounds = index_range(pred["expr"], pred["variables"][0]) if len(pred["columns"]) == 1 else None
+    if bounds is None:
+        return nrow / 3
+    op, val = bounds
+    try:
+        index = tbl.loaded_index(col)
+        if index is not None:
+            return index.count(op, val)
+        if op == "==":
+            return nrow / distinct
+        if op == "!=":
+            return nrow - nrow / distinct
+        if col in tbl.stats and tbl.stats[col]["histogram"]:
+            below = histogram_fraction(tbl.stats[col]["histogram"], val)
+            equal = 1 / distinct
+            fraction = {"<":below, "<=":below + equal, ">":1 - below - equal, ">=":1 - below}[op]
+            return nrow * min(max(fraction, 0), 1)
+    except TypeError:
+        pass
+    return nrow / 3
+
+def histogram_fraction(bounds, val):
+    #Estimates the fraction of values below val from equi-depth bucket boundaries,
+    #interpolating linearly inside the bucket val falls in
+    i = bisect.bisect_left(bounds, val)
+    if i == 0:
+        return 0
+    if i >= len(bounds):
+        return 1
+    lo, hi = bounds[i-1], bounds[i]
+    within = 0.5
+    if isinstance(val, (int, float)) and hi > lo:
+        within = (val - lo) / (hi - lo)
+    return (i - 1 + within) / (len(bounds) - 1)
+
+def scan_cost(pred, access, estimate):
+    #Cost, in rows touched, of evaluating a predicate over its whole table with an access path.
+    #A reopened table builds its column index on first use, which touches every row
+    tbl = TABLES[pred["df"]]
+    nrow = max(tbl.nrow, 1)
+    build = nrow if "table" in tbl.pending else 0
+    if access == "index":
+        return math.log(nrow + 1, 2) + estimate
+    if access == "bitmap":
+        values = len(pred["list"]) if pred["kind"] == "in" else 1
+        return values * nrow / 64
+    if access == "lookup":
+        return build + (len(pred["list"]) if pred["kind"] == "in" else 1) + estimate
+    if access == "vectorized":
+        return nrow / 20 + estimate
+    if access == "values":
+        return build + tbl.distinct(pred["columns"][0]) + estimate
+    return nrow
+
+def plan_node(node, nrow):
+    """
+    Plans one node of a table's where tree, recording on it the estimated
+    number of matching rows and the cost of evaluating it over the whole
+    table. Under "and", the children run most selective first and each
+    later one either scans and intersects or only filters the rows left
+    by the children before it, whichever touches fewer rows.
+
+    Params:
+        node: a where tree node from split_where_tree
+        nrow: the number of rows in the node's table
+    """
+    n = max(nrow, 1)
+    node["method"] = "scan"
+    if node["op"] == "pred":
+        node["estimate"] = estimate_rows(node["pred"])
+        node["access"] = access_path(node["pred"], node["estimate"])
+        node["cost"] = scan_cost(node["pred"], node["access"], node["estimate"])
+        return node
+
+    for child in node["children"]:
+        plan_node(child, nrow)
+
+    if node["op"] == "not":
+        node["estimate"] = nrow - node["children"][0]["estimate"]
+        node["cost"] = node["children"][0]["cost"]
+    elif node["op"] == "or":
+        missing = 1
+        for child in node["children"]:
+            missing *= 1 - child["estimate"] / n
+        node["estimate"] = nrow * (1 - missing)
+        node["cost"] = sum(child["cost"] for child in node["children"])
+    else:
+        node["children"].sort(key = lambda child: (child["estimate"], child["cost"]))
+        estimate = nrow
+        for i, child in enumerate(node["children"]):
+            if i > 0 and estimate <= child["cost"] + child["estimate"]:
+                child["method"] = "filter"
+                child["cost"] = estimate
+            estimate = estimate * child["estimate"] / n
+        node["estimate"] = estimate
+        node["cost"] = sum(child["cost"] for child in node["children"])
+    return node
+
+def plan_select(dfs, trees, join_cols):
+    """
+    Cost-based planner for a select. It plans each table's where tree with
+    plan_node, then for a join picks the algorithm and build side from the
+    estimated filtered sizes, before any rows are materialized.
+
+    Params:
+        dfs: the table names in the query
+        trees: dictionary of table -> where tree from split_where_tree
+        join_cols: dictionary of table -> join column
+
+    Return:
+        the plan dictionary
+    """
+    plan = {"tables":{}, "join":None}
     for df in dfs:
-        if df in cond_columns:
-            subset.extend([cond_columns[df][cond] for cond in cond_columns[df]])
-    or_keys = []
-    for sublist in subset:
-        for item in sublist:
-            if item not in or_keys:
-                or_keys.append(item)
-    return or_keys
+        tree = trees.get(df)
+        if tree is not None:
+            plan_node(tree, TABLES[df].nrow)
+        plan["tables"][df] = {
+            "tree":tree,
+            "estimate":tree["estimate"] if tree is not None else TABLES[df].nrow
+        }
+
+    if len(dfs) > 1:
+        plan["join"] = choose_join(dfs[0], dfs[1], plan["tables"][dfs[0]]["estimate"], plan["tables"][dfs[1]]["estimate"],
+                                   join_cols[dfs[0]], join_cols[dfs[1]])
+    return plan
+
+def eval_node(df, node):
+    """
+    Evaluates a planned where tree node over the whole table
+
+    Return:
+        Bitmap of the matching row ids
+    """
+    if node["op"] == "pred":
+        return scan_predicate(node["pred"], node["access"])
+    if node["op"] == "not":
+        return TABLES[df].live_bitmap() - eval_node(df, node["children"][0])
+    if node["op"] == "or":
+        result = Bitmap()
+        for child in node["children"]:
+            result = result | eval_node(df, child)
+        return result
+
+    result = None
+    for child in node["children"]:
+        if result is None:
+            result = eval_node(df, child)
+        elif child["method"] == "filter":
+            result = Bitmap.from_rids(filter_node(child, result.to_rids()))
+        else:
+            result = result & eval_node(df, child)
+        if not result:
+            break
+    return result
+
+def filter_node(node, rids):
+    """
+    Keeps the row ids from rids that satisfy a where tree node, testing each row directly
+
+    Return:
+        list of the matching row ids
+    """
+    if node["op"] == "pred":
+        return filter_predicate(node["pred"], rids)
+    if node["op"] == "not":
+        matched = set(filter_node(node["children"][0], rids))
+        return [rid for rid in rids if rid not in matched]
+    if node["op"] == "or":
+        matched = set()
+        for child in node["children"]:
+            matched.update(filter_node(child, rids))
+        return [rid for rid in rids if rid in matched]
+    for child in node["children"]:
+        rids = filter_node(child, rids)
+        if not rids:
+            break
+    return rids
+
+def filter_table(df, table_plan):
+    """
+    Runs the planned where tree for one table
+
+    Return:
+        list of matching row ids, or None if the table has no conditions
+    """
+    if table_plan["tree"] is None:
+        return None
+    return eval_node(df, table_plan["tree"]).to_rids()
+
+def print_plan(plan):
+    #Prints the chosen plan for "explain select ..."
+    table = PrettyTable()
+    table.field_names = ["table", "condition", "method", "access", "est. rows", "cost"]
+    table.align["condition"] = "l"
+
+    def add_rows(df, node, depth):
+        label = node["pred"]["cond"] if node["op"] == "pred" else node["op"].upper()
+        table.add_row([df, "  " * depth + label, node["method"], node.get("access", "") if node["method"] == "scan" else "",
+                       round(node["estimate"]), round(node["cost"])])
+        for child in node.get("children", []):
+            add_rows(df, child, depth + 1)
+
+    for df in plan["tables"]:
+        if plan["tables"][df]["tree"] is not None:
+            add_rows(df, plan["tables"][df]["tree"], 0)
+        table.add_row([df, "", "output", "", round(plan["tables"][df]["estimate"]), ""])
+    print(table)
+    if plan["join"]:
+        print(f"join: {plan['join']['algorithm']}, build side {plan['join']['build']}, cost {round(plan['join']['cost'])}")
 
 # endregion OPTIMIZATIONS #####################################################################
 
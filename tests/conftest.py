@@ -0,0 +1,54 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import P3
+
+
+@pytest.fixture
+def p3(monkeypatch):
+    """P3 with no tables, caches or open database, run from the repo root"""
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setitem(P3.SETTINGS, "load_workers", 1)
+    P3.TABLES.clear()
+    P3.PREPARED.clear()
+    P3.invalidate_plans()
+    P3.RESULT_CACHE.clear()
+    P3.WAL = None
+    yield P3
+    if P3.WAL is not None and P3.WAL.file is not None:
+        P3.WAL.file.close()
+    P3.WAL = None
+    P3.TABLES.clear()
+    P3.PREPARED.clear()
+    P3.invalidate_plans()
+    P3.RESULT_CACHE.clear()
+
+
+@pytest.fixture
+def df2(p3):
+    p3.process_input([
+        "create table df2 (name varchar 3, decimal float, state varchar 20, year int, primary key (name))",
+        "load data infile 'data/df2.csv' into table df2 fields terminated by ',' ignore 1 rows",
+    ])
+    return p3.TABLES["df2"]
+
+
+def column_index_agrees(tbl):
+    """Whether every column index maps exactly the live rows to their stored values"""
+    for col in tbl.columns:
+        expected = {}
+        for rid in tbl.row_ids():
+            expected.setdefault(tbl.store[col][rid], []).append(rid)
+        if col == tbl.key:
+            actual = {val: [rid] for val, rid in tbl.table[col].items()}
+        else:
+            actual = {val: tbl.rows_with(col, val) for val in list(tbl.table[col])}
+            actual = {val: sorted(rids) for val, rids in actual.items() if rids}
+        if actual != expected:
+            return False
+    return True
@@ -0,0 +1,46 @@
+import csv
+from collections import defaultdict
+
+import P3
+
+
+def df2_rows():
+    with open("data/df2.csv") as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        row["decimal"] = float(row["decimal"])
+        row["year"] = int(row["year"])
+    return rows
+
+
+def test_group_by_matches_a_python_group_by(df2):
+    groups = defaultdict(list)
+    for row in df2_rows():
+        groups[row["state"]].append(row)
+    out = P3.process_select("select state, avg(decimal), count(*), max(year) as hi from df2 group by state",
+                            do_print = False)
+    got = dict(zip(out["state"], zip(out["decimal"], out["count(*)"], out["hi"])))
+    assert set(got) == set(groups)
+    for state, rows in groups.items():
+        avg, count, hi = got[state]
+        assert abs(avg - sum(r["decimal"] for r in rows) / len(rows)) < 1e-9
+        assert count == len(rows)
+        assert hi == max(r["year"] for r in rows)
+
+
+def test_aggregate_without_group_by(df2):
+    years = [row["year"] for row in df2_rows() if row["year"] > 1950]
+    out = P3.process_select("select count(*), min(year) from df2 where year > 1950", do_print = False)
+    assert out == {"count(*)": [len(years)], "year": [min(years)]}
+
+
+def test_unsupported_aggregate_is_an_error(df2, capsys):
+    assert P3.process_select("select state, median(year) from df2 group by state", do_print = False) == 1
+    assert "ERROR" in capsys.readouterr().out
+
+
+def test_plain_select_is_not_aggregated(df2):
+    years = sorted(row["year"] for row in df2_rows() if row["year"] < 1902)
+    out = P3.process_select("select name, year from df2 where year < 1902", do_print = False)
+    assert list(out) == ["name", "year"]
+    assert sorted(out["year"]) == years
@@ -0,0 +1,50 @@
+import P3
+
+
+def make_table(p3):
+    p3.process_input(["create table t (k int, s varchar 3, f float, primary key (k))"])
+    return p3.TABLES["t"]
+
+
+def rows_of(tbl):
+    return [[tbl.store[col][rid] for col in tbl.columns] for rid in tbl.row_ids()]
+
+
+def test_single_and_multi_row_insert_store_the_same_values(p3):
+    single = make_table(p3)
+    p3.process_input(["insert into t (k, s, f) values (1, abcdef, 2)",
+                      "insert into t (k, s, f) values (2, xy, 2.5)"])
+    expected = rows_of(single)
+    p3.process_input(["drop table t"])
+    batch = make_table(p3)
+    p3.process_input(["insert into t (k, s, f) values (1, abcdef, 2), (2, xy, 2.5)"])
+    assert rows_of(batch) == expected == [[1, "abc", 2.0], [2, "xy", 2.5]]
+
+
+def test_prepared_insert_casts_like_plain_insert(p3):
+    tbl = make_table(p3)
+    p3.prepare("ins", "insert into t (k, s, f) values (?, ?, 1)")
+    p3.execute("ins", ["3", "abcdef"])
+    assert rows_of(tbl) == [[3, "abc", 1.0]]
+    assert tbl.table["s"] == {"abc":[0]}
+
+
+def test_multi_row_insert_is_all_or_nothing(p3, capsys):
+    tbl = make_table(p3)
+    p3.process_input(["insert into t (k, s, f) values (1, a, 1)"])
+    p3.process_input(["insert into t (k, s, f) values (4, x, 1), (1, y, 1), (5, z, 1)"])
+    assert "duplicate value 1" in capsys.readouterr().out
+    assert rows_of(tbl) == [[1, "a", 1.0]]
+    assert sorted(tbl.table["k"]) == [1]
+    p3.process_input(["insert into t (k, s, f) values (6, x, 1), (7, y, nope)"])
+    assert "cannot convert value nope" in capsys.readouterr().out
+    assert rows_of(tbl) == [[1, "a", 1.0]]
+
+
+def test_multi_row_insert_checks_foreign_keys_first(p3, capsys):
+    p3.process_input(["create table p (c varchar 5, primary key (c))",
+                      "insert into p (c) values (red)",
+                      "create table c (id int, col varchar 5, primary key (id), foreign key (col) references p (c))",
+                      "insert into c (id, col) values (1, red), (2, blue)"])
+    assert "does not exist in foreign key table p" in capsys.readouterr().out
+    assert p3.TABLES["c"].nrow == 0
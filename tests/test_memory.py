@@ -0,0 +1,29 @@
+import sys
+
+import P3
+
+
+def test_varchar_key_column_is_stored_plain(df2):
+    keys = df2.store["name"]
+    assert isinstance(keys, P3.KeyColumn)
+    assert isinstance(df2.store["state"], P3.VarcharColumn)
+    # The rows hold the key index's own string objects
+    for key, rid in df2.table["name"].items():
+        assert keys[rid] is key
+
+
+def test_columnar_usage_counts_the_column_indexes(df2):
+    usage = df2.memory_usage()
+    rows = sum(df2.store[col].nbytes() for col in df2.columns)
+    postings = sum(sys.getsizeof(rids) for rids in df2.table["state"].values())
+    assert usage["columnar"] > rows + postings
+    assert usage["row dicts"] > usage["columnar"]
+
+
+def test_reopened_key_column_keeps_its_keys(df2, tmp_path):
+    keys = list(df2.store["name"].data)
+    path = tmp_path / "df2.tbl"
+    P3.process_input([f"save table df2 '{path}'", "drop table df2", f"open table df2 '{path}'"])
+    tbl = P3.TABLES["df2"]
+    assert isinstance(tbl.store["name"], P3.KeyColumn)
+    assert list(tbl.store["name"].take(range(tbl.nrow))) == keys
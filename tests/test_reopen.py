@@ -0,0 +1,40 @@
+import P3
+
+
+def save_and_reopen(p3, tmp_path):
+    path = tmp_path / "df2.tbl"
+    p3.process_input(["create index iy on df2 (year)",
+                      "create bitmap index ist on df2 (state)",
+                      f"save table df2 '{path}'",
+                      "drop table df2",
+                      f"open table df2 '{path}'"])
+    return p3.TABLES["df2"]
+
+
+QUERIES = [
+    "select b.name from df2 as b where b.year > 1990",
+    "select b.name from df2 as b where b.state == 'Ohio'",
+    "select b.name from df2 as b where b.state in ('Ohio', 'Utah') and b.decimal < 0.5",
+]
+
+
+def test_reopen_gives_the_same_results(df2, tmp_path):
+    expected = [P3.process_select(q, do_print = False) for q in QUERIES]
+    save_and_reopen(P3, tmp_path)
+    P3.RESULT_CACHE.clear()
+    assert [P3.process_select(q, do_print = False) for q in QUERIES] == expected
+
+
+def test_where_queries_keep_reopened_table_lazy(df2, tmp_path):
+    tbl = save_and_reopen(P3, tmp_path)
+    for q in QUERIES:
+        P3.process_select(q, do_print = False)
+    assert {"table", "indexes", "bitmap_indexes"} <= set(tbl.pending)
+
+
+def test_bitmap_index_builds_from_the_store(df2, tmp_path):
+    tbl = save_and_reopen(P3, tmp_path)
+    bitmaps = tbl.bitmap_indexes["state"]
+    assert "table" in tbl.pending
+    ohio = [rid for rid in tbl.row_ids() if tbl.store["state"][rid] == "Ohio"]
+    assert sorted(bitmaps.lookup(["Ohio"]).to_rids()) == ohio
@@ -0,0 +1,60 @@
+import csv
+
+import pytest
+
+import P3
+from conftest import column_index_agrees
+
+
+@pytest.fixture
+def both(p3):
+    p3.process_input([
+        "create table df1 (Letter varchar 3, Number int, Color varchar 10, primary key (Letter))",
+        "load data infile 'data/df1.csv' into table df1 fields terminated by ',' ignore 1 rows",
+        "create table df2 (name varchar 3, decimal float, state varchar 20, year int, primary key (name), foreign key (name) references df1 (Letter))",
+        "load data infile 'data/df2.csv' into table df2 fields terminated by ',' ignore 1 rows",
+    ])
+    with open("data/df1.csv") as f:
+        df1 = {row["Letter"]: row for row in csv.DictReader(f)}
+    with open("data/df2.csv") as f:
+        df2 = list(csv.DictReader(f))
+    return df1, df2
+
+
+def test_join_matches_a_nested_loop(both):
+    df1, df2 = both
+    expected = sorted((row["name"], df1[row["name"]]["Color"]) for row in df2 if int(row["year"]) < 1910)
+    out = P3.process_select("select a.Color, b.name from df1 a, df2 b join a.Letter = b.name where b.year < 1910",
+                            do_print = False)
+    assert sorted(zip(out["name"], out["Color"])) == expected
+
+
+def test_order_by_with_limit_and_offset(both):
+    years = sorted((int(row["year"]) for row in both[1]), reverse = True)
+    out = P3.process_select("select name, year from df2 order by year desc limit 5 offset 2", do_print = False)
+    assert out["year"] == years[2:7]
+
+
+def test_cached_result_is_dropped_after_an_insert(both):
+    query = "select Letter from df1 where Number == 7"
+    before = P3.process_select(query, do_print = False)["Letter"]
+    assert P3.process_select(query, do_print = False)["Letter"] == before
+    P3.process_input(["insert into df1 (Letter, Number, Color) values (zz9, 7, Red)"])
+    assert sorted(P3.process_select(query, do_print = False)["Letter"]) == sorted(before + ["zz9"])
+
+
+def test_delete_cascades_to_child_rows(both):
+    df1, df2 = both
+    kept = {letter for letter, row in df1.items() if int(row["Number"]) <= 20}
+    P3.process_input(["delete from df1 where Number > 20"])
+    assert set(P3.process_select("select Letter from df1", do_print = False)["Letter"]) == kept
+    names = P3.process_select("select name from df2", do_print = False)["name"]
+    assert sorted(names) == sorted(row["name"] for row in df2 if row["name"] in kept)
+    assert column_index_agrees(P3.TABLES["df1"])
+    assert column_index_agrees(P3.TABLES["df2"])
+
+
+def test_insert_checks_the_foreign_key(both, capsys):
+    P3.process_input(["insert into df2 (name, decimal, state, year) values (qq1, 0.5, Ohio, 1999)"])
+    assert "ERROR" in capsys.readouterr().out
+    assert "qq1" not in P3.TABLES["df2"].table["name"]
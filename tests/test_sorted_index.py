@@ -0,0 +1,47 @@
+import random
+
+import pytest
+
+import P3
+
+
+def reference(pairs):
+    # Entries in value order, rows of equal value in the order they were added
+    ordered = sorted(range(len(pairs)), key = lambda i: pairs[i][0])
+    return [pairs[i][0] for i in ordered], [pairs[i][1] for i in ordered]
+
+
+@pytest.mark.parametrize("batch", [1, 3, 40, 500])
+def test_insert_many_matches_sorted_order(batch):
+    rng = random.Random(batch)
+    index = P3.SortedIndex("i", "v")
+    pairs = []
+    rid = 0
+    for _ in range(6):
+        values = [rng.randint(0, 50) for _ in range(batch)]
+        rids = list(range(rid, rid + batch))
+        rid += batch
+        index.insert_many(values, rids)
+        pairs += list(zip(values, rids))
+    assert (index.values, index.rids) == reference(pairs)
+
+
+@pytest.mark.parametrize("batch", [2, 40, 300])
+def test_remove_many_keeps_the_rest(batch):
+    rng = random.Random(batch)
+    index = P3.SortedIndex("i", "v")
+    pairs = [(rng.randint(0, 30), rid) for rid in range(1000)]
+    index.insert_many([v for v, _ in pairs], [r for _, r in pairs])
+    gone = rng.sample(pairs, batch)
+    index.remove_many([v for v, _ in gone], [r for _, r in gone])
+    assert (index.values, index.rids) == reference([p for p in pairs if p not in gone])
+
+
+def test_batch_insert_and_update_keep_index_in_sync(df2):
+    P3.process_input(["create index iy on df2 (year)",
+                      "insert into df2 (name, decimal, state, year) values (zz1, 0.1, Ohio, 1950), (zz2, 0.2, Ohio, 1850)",
+                      "update df2 set year = 1901 where state == 'Ohio'"])
+    index = df2.indexes["year"]
+    assert index.values == sorted(index.values)
+    assert sorted(index.rids) == df2.row_ids()
+    assert all(df2.store["year"][rid] == val for val, rid in zip(index.values, index.rids))
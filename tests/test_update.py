@@ -0,0 +1,30 @@
+import P3
+
+from conftest import column_index_agrees
+
+
+def year_of(df2, name):
+    return df2.store["year"][df2.table["name"][name]]
+
+
+def test_update_sets_matching_rows(df2):
+    P3.process_input(["update df2 set year = 2001, state = Utah where name == 'aaa'"])
+    assert year_of(df2, "aaa") == 2001
+    assert df2.rows_with("state", "Utah").count(df2.table["name"]["aaa"]) == 1
+    assert column_index_agrees(df2)
+
+
+def test_out_of_range_update_leaves_table_unchanged(df2, capsys):
+    before = year_of(df2, "aaa")
+    P3.process_input(["update df2 set year = 99999999999999999999 where name == 'aaa'"])
+    assert "ERROR" in capsys.readouterr().out
+    assert year_of(df2, "aaa") == before
+    assert 99999999999999999999 not in df2.table["year"]
+    assert column_index_agrees(df2)
+
+
+def test_out_of_range_update_leaves_sorted_index_unchanged(df2):
+    P3.process_input(["create index iy on df2 (year)",
+                      "update df2 set year = 99999999999999999999 where year < 1950"])
+    assert P3.process_select("select a.name from df2 as a where a.year > 3000", do_print = False) == {"name":[]}
+    assert column_index_agrees(df2)
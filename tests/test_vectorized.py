@@ -0,0 +1,59 @@
+import pytest
+
+import P3
+
+pytestmark = pytest.mark.skipif(P3.np is None, reason = "needs NumPy")
+
+CONDITIONS = [
+    "t___b * 4000000000 < 0",
+    "t___b * 4000000000 > 0",
+    "t___b ** 3 > 10",
+    "-t___b < -2999999999",
+    "t___b + t___k > 3000000000",
+    "t___b * 3 - t___k > 1000",
+    "(t___f * 800) + t___k < 1910",
+]
+
+
+@pytest.fixture
+def big_ints(p3):
+    p3.process_input(["create table t (k int, b int, f float, primary key (k))"])
+    p3.process_input([f"insert into t (k, b, f) values ({i}, {3000000000 if i % 2 else i}, {i / 7})"
+                      for i in range(500)])
+    return p3.TABLES["t"]
+
+
+def scalar_rows(tbl, cond, variables, columns):
+    predicate = P3.compile_predicate(cond, variables)
+    return [rid for rid in tbl.row_ids() if predicate(*[tbl.store[col][rid] for col in columns])]
+
+
+@pytest.mark.parametrize("cond", CONDITIONS)
+def test_vectorized_matches_row_by_row(big_ints, cond):
+    variables = tuple(sorted({v for v in ["t___b", "t___k", "t___f"] if v in cond}))
+    columns = [v.split("___")[1] for v in variables]
+    rids = P3.vectorized_filter("t", cond, variables, columns)
+    assert rids is not None
+    assert list(rids.to_rids()) == scalar_rows(big_ints, cond, variables, columns)
+
+
+def test_overflow_check_uses_column_bounds(big_ints):
+    b = big_ints.store["b"].to_numpy()
+    assert P3.may_overflow("t___b * 4000000000 < 0", ("t___b",), [b])
+    assert not P3.may_overflow("t___b * 3 < 0", ("t___b",), [b])
+    assert not P3.may_overflow("t___b > 0", ("t___b",), [b])
+    f = big_ints.store["f"].to_numpy()
+    assert not P3.may_overflow("(t___f * 800) + t___b < 1910", ("t___b", "t___f"), [b, f])
+
+
+def test_float_overflow_falls_back(big_ints):
+    assert P3.vectorized_filter("t", "t___f * 1e308 > 1", ("t___f",), ["f"]) is None
+
+
+def test_vectorized_select_matches_scalar(df2, monkeypatch):
+    query = "select b.name from df2 as b where (b.decimal*800) + b.year < 1910"
+    vectorized = P3.process_select(query, do_print = False)
+    monkeypatch.setitem(P3.SETTINGS, "vectorized", False)
+    P3.invalidate_plans()
+    P3.RESULT_CACHE.clear()
+    assert P3.process_select(query, do_print = False) == vectorized
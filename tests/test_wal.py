@@ -0,0 +1,71 @@
+import P3
+
+
+def reopen(p3, directory):
+    # What a restart sees: only the files in the database directory
+    p3.WAL.file.close()
+    p3.WAL = None
+    p3.TABLES.clear()
+    p3.PREPARED.clear()
+    p3.invalidate_plans()
+    p3.process_input([f"open database '{directory}'"])
+
+
+def contents(p3):
+    return p3.process_select("select a.k, a.c from t as a", do_print = False)
+
+
+def test_plain_statements_replay(p3, tmp_path):
+    p3.process_input([f"open database '{tmp_path}'",
+                      "create table t (k int, c varchar 10, primary key (k))",
+                      "insert into t (k, c) values (1, red), (2, blue)",
+                      "update t set c = green where k == 2",
+                      "delete from t where k == 1"])
+    before = contents(p3)
+    reopen(p3, tmp_path)
+    assert contents(p3) == before == {"k":[2], "c":["green"]}
+
+
+def test_prepared_values_replay_exactly(p3, tmp_path):
+    p3.process_input([f"open database '{tmp_path}'",
+                      "create table t (k int, c varchar 10, primary key (k))",
+                      "prepare ins as insert into t (k, c) values (?, ?)",
+                      "prepare up as update t set c = ? where c == ?",
+                      "execute ins (1, xy)"])
+    for values in [[2, "New York"], [3, "a,b"], [4, "(x)"], [5, "it's"]]:
+        assert p3.execute("ins", values) == 0
+    assert p3.execute("up", ["San Jose", "New York"]) == 0
+    before = contents(p3)
+    reopen(p3, tmp_path)
+    assert contents(p3) == before
+    assert before["c"] == ["xy", "San Jose", "a,b", "(x)", "it's"]
+
+
+def test_durability_does_not_change_accepted_values(p3, tmp_path):
+    p3.process_input(["create table t (k int, c varchar 10, primary key (k))",
+                      "prepare ins as insert into t (k, c) values (?, ?)"])
+    assert p3.execute("ins", [1, "New York"]) == 0
+    p3.process_input([f"open database '{tmp_path}'"])
+    assert p3.execute("ins", [2, "New York"]) == 0
+    assert contents(p3)["c"] == ["New York", "New York"]
+
+
+def test_execute_commits_before_returning(p3, tmp_path):
+    p3.process_input([f"open database '{tmp_path}'",
+                      "create table t (k int, c varchar 10, primary key (k))",
+                      "prepare ins as insert into t (k, c) values (?, ?)"])
+    p3.execute("ins", [1, "api"])
+    assert p3.WAL.group == []
+    reopen(p3, tmp_path)
+    assert contents(p3) == {"k":[1], "c":["api"]}
+
+
+def test_checkpoint_keeps_one_generation(p3, tmp_path):
+    p3.process_input([f"open database '{tmp_path}'",
+                      "create table t (k int, c varchar 10, primary key (k))",
+                      "insert into t (k, c) values (1, red)",
+                      "checkpoint",
+                      "insert into t (k, c) values (2, blue)"])
+    assert sorted(f.name for f in tmp_path.iterdir()) == ["manifest.json", "t.1.tbl", "wal.1.log"]
+    reopen(p3, tmp_path)
+    assert contents(p3) == {"k":[1, 2], "c":["red", "blue"]}